@@ -0,0 +1,80 @@
+"""Coroutine variants of the matching functions, for asyncio programs.
+
+Matching a short string is quicker than handing it to another thread, so
+strings shorter than the async threshold are matched inline. Longer ones
+are matched in the async executor, which keeps the event loop running
+meanwhile: RE2 releases the GIL while it scans.
+"""
+import asyncio
+import functools
+
+from re2._re2 import StreamScanner, compile
+
+_threshold = 1 << 16
+_executor = None
+# The loop running the coroutine; get_event_loop() does the same on 3.6.
+_get_running_loop = getattr(asyncio, 'get_running_loop',
+                            asyncio.get_event_loop)
+
+
+def set_async_threshold(size):
+    """
+    Match strings of size characters or more in the async executor rather
+    than in the event loop (64KiB by default).
+    """
+    global _threshold
+    if size < 0:
+        raise ValueError("the async threshold must not be negative")
+    _threshold = size
+
+
+def set_async_executor(executor):
+    """
+    Match long strings in executor, or in the default executor of the event
+    loop if executor is None (the default).
+    """
+    global _executor
+    _executor = executor
+
+
+async def _call(method, string, *args):
+    if len(string) < _threshold:
+        return method(*args)
+    loop = _get_running_loop()
+    return await loop.run_in_executor(_executor,
+                                      functools.partial(method, *args))
+
+
+async def _search(pattern, string, *args):
+    return await _call(pattern.search, string, string, *args)
+
+
+async def _findall(pattern, string, *args):
+    return await _call(pattern.findall, string, string, *args)
+
+
+async def _sub(pattern, repl, string, count=0):
+    return await _call(pattern.sub, string, repl, string, count)
+
+
+async def _finditer_stream(pattern, reader, chunk_size, max_match_len):
+    scanner = StreamScanner(pattern, max_match_len)
+    while not scanner.eof:
+        scanner.feed(await reader.read(chunk_size))
+        for m in scanner:
+            yield m
+
+
+async def asearch(pattern, string, flags=0):
+    """Coroutine version of search()."""
+    return await _search(compile(pattern, flags), string)
+
+
+async def afindall(pattern, string, flags=0):
+    """Coroutine version of findall()."""
+    return await _findall(compile(pattern, flags), string)
+
+
+async def asub(pattern, repl, string, count=0, flags=0):
+    """Coroutine version of sub()."""
+    return await _sub(compile(pattern, flags), repl, string, count)
@@ -1,14 +1,20 @@
 # see https://github.com/cython/cython/wiki/FAQ#id35
 from libcpp.string cimport string as cpp_string
+from libcpp.vector cimport vector
 #from libcpp.map cimport map as cpp_map
 from libcppmap cimport map as cpp_map    # until my PR is accepted
+from cpython.buffer cimport PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
 
 cdef int MAGIC=7
 
 cdef extern from "Python.h":
+    cdef bint PyUnicode_Check(object)
+    cdef object PyUnicode_DecodeUTF8(const char*, Py_ssize_t, const char*)
     IF IS_PY_THREE == 1:
         cdef bint PyBytes_Check(object)
         cdef int PyBytes_AsStringAndSize(object, char**, Py_ssize_t*)
+        cdef const char* PyUnicode_AsUTF8AndSize(object, Py_ssize_t*) except NULL
+        cdef bint PyUnicode_IS_ASCII(object)
     ELSE:
         cdef bint PyString_Check(object)
         cdef int PyString_AsStringAndSize(object, char**, Py_ssize_t*)
@@ -44,7 +50,7 @@ cdef inline bint is_bytes(s):
     ELSE:
         return PyString_Check(s)
 
-cdef extern from "re2/stringpiece.h" namespace "re2":
+cdef extern from "re2/stringpiece.h" namespace "re2" nogil:
     cdef cppclass StringPiece:
         StringPiece() except +
         StringPiece(const char*) except +
@@ -54,7 +60,7 @@ cdef extern from "re2/stringpiece.h" namespace "re2":
         int length()
  
 cdef extern from "re2/re2.h" namespace "re2":
-    cdef enum Anchor:
+    cpdef enum Anchor "RE2::Anchor":
         UNANCHORED "RE2::UNANCHORED"
         ANCHOR_START "RE2::ANCHOR_START"
         ANCHOR_BOTH "RE2::ANCHOR_BOTH"
@@ -101,16 +107,45 @@ cdef extern from "re2/re2.h" namespace "re2":
         void set_encoding(re2_Encoding encoding)
 
     cdef cppclass RE2:
-        RE2(const StringPiece pattern, Options option) except +
-        RE2(const StringPiece pattern) except +
+        RE2(const StringPiece pattern, Options option) nogil except +
+        RE2(const StringPiece pattern) nogil except +
         int Match(const StringPiece text, int startpos, int endpos,
                   Anchor anchor, StringPiece * match, int nmatch) nogil
         int NumberOfCapturingGroups() const
+        int ProgramSize() const
         int ok()
         const cpp_string pattern()
+        const Options& options() nogil const
         cpp_string error()
         ErrorCode error_code()
         const cpp_map[cpp_string, int]& NamedCapturingGroups() const
+        bint PossibleMatchRange(cpp_string* min, cpp_string* max,
+                                int maxlen) const
+
+cdef extern from "re2/set.h" namespace "re2":
+    cdef cppclass RE2_Set "re2::RE2::Set":
+        RE2_Set(const Options& options, re2_Anchor anchor) except +
+        int Add(const StringPiece& pattern, cpp_string* error)
+        bint Compile() nogil
+        bint Match(const StringPiece& text, vector[int]* v) nogil const
+
+cdef extern from "re2/filtered_re2.h" namespace "re2":
+    cdef cppclass FilteredRE2:
+        FilteredRE2() except +
+        int Add(const StringPiece& pattern, const Options& options, int* id)
+        void Compile(vector[cpp_string]* strings_to_match)
+        int FirstMatch(const StringPiece& text,
+                       const vector[int]& atoms) nogil const
+        bint AllMatches(const StringPiece& text, const vector[int]& atoms,
+                        vector[int]* matching_regexps) nogil const
+        int NumRegexps() const
+
+cdef extern from "_atom_matcher.h":
+    cdef cppclass AtomMatcher:
+        AtomMatcher() except +
+        void Add(const cpp_string& atom, int index)
+        void Build()
+        bint Match(const char* text, size_t n, vector[int]* atoms) nogil const
 
 # This header is used for ways to hack^Wbypass the cython
 # issues.
@@ -135,3 +170,6 @@ cdef extern from "_re2macros.h":
     int pattern_GlobalReplace(cpp_string* str,
                               const RE2 pattern,
                               const StringPiece rewrite)
+
+    ctypedef void (*parallel_fn)(void*, int) nogil
+    void run_parallel(int n, parallel_fn fn, void* arg) nogil
@@ -3,7 +3,23 @@
 import sys
 import re
 from cython.operator cimport preincrement as inc, dereference as deref
+from libcpp.algorithm cimport sort
+from libc.string cimport memchr
 import warnings
+import multiprocessing
+import mmap
+import os
+import bisect
+import collections
+import time
+import weakref
+import threading
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
 
 I = re.I
 IGNORECASE = re.IGNORECASE
@@ -53,6 +69,7 @@ class RegexError(re.error):
 error = RegexError
 
 cdef int _I = I, _M = M, _S = S, _U = U, _X = X, _L = L
+cdef int _A = getattr(re, 'ASCII', 0)
 
 cdef inline bytes cpp_to_pystring(cpp_string input_str):
     # This function is a quick converter from a std::string object
@@ -60,15 +77,500 @@ cdef inline bytes cpp_to_pystring(cpp_string input_str):
     # despite spurious or missing null characters.
     return input_str.c_str()[:input_str.length()]
 
+cdef class InputBuffer:
+    """
+    Holds a buffer export of a subject string for as long as a Match
+    (or an iterator) points into its memory. This keeps the data from
+    being resized or unmapped underneath us, without copying it.
+    """
+    cdef Py_buffer view
+
+    def __dealloc__(self):
+        PyBuffer_Release(&self.view)
+
+cdef enum InputKind:
+    BYTES_INPUT = 0     # bytes or a buffer: bytes results, byte offsets
+    ASCII_INPUT = 1     # ascii-only str: str results, offsets are unchanged
+    UNICODE_INPUT = 2   # any other str: str results, offsets are translated
+
+cdef object input_to_cstr(object o, char** c_str_ptr, Py_ssize_t* length,
+                          int* kind):
+    # Get a pointer to the subject string without copying it, and return
+    # the object that has to be kept alive for the pointer to stay valid.
+    # Byte strings own their data, anything else exporting a contiguous
+    # buffer (bytearray, memoryview, mmap, array, ...) is held through
+    # an InputBuffer. Unicode strings are matched through the UTF-8
+    # representation CPython caches on the str object itself.
+    cdef InputBuffer buf
+    cdef bytes encoded
+    kind[0] = BYTES_INPUT
+    if is_bytes(o):
+        pystring_to_cstr(o, c_str_ptr, length)
+        return o
+    if PyUnicode_Check(o):
+        IF IS_PY_THREE == 1:
+            c_str_ptr[0] = as_char(PyUnicode_AsUTF8AndSize(o, length))
+            if PyUnicode_IS_ASCII(o):
+                kind[0] = ASCII_INPUT
+            else:
+                kind[0] = UNICODE_INPUT
+            return o
+        ELSE:
+            encoded = (<unicode>o).encode('utf8')
+            pystring_to_cstr(encoded, c_str_ptr, length)
+            kind[0] = UNICODE_INPUT
+            return encoded
+    if not PyObject_CheckBuffer(o):
+        raise TypeError("expected string or buffer")
+    buf = InputBuffer.__new__(InputBuffer)
+    PyObject_GetBuffer(o, &buf.view, PyBUF_SIMPLE)
+    c_str_ptr[0] = <char*>buf.view.buf
+    length[0] = buf.view.len
+    return buf
+
+cdef inline object slice_result(const char* data, Py_ssize_t length, int kind):
+    # Turn a piece of the subject string into a result of the right type.
+    if kind == BYTES_INPUT:
+        return data[:length]
+    return PyUnicode_DecodeUTF8(data, length, NULL)
+
+cdef inline Py_ssize_t utf8_char_count(const char* s, Py_ssize_t n) nogil:
+    # Number of characters in the first n bytes of s.
+    cdef Py_ssize_t i
+    cdef Py_ssize_t count = 0
+    for i in range(n):
+        if (s[i] & 0xC0) != 0x80:
+            count += 1
+    return count
+
+cdef inline Py_ssize_t utf8_skip(const char* s, Py_ssize_t size,
+                                 Py_ssize_t start, Py_ssize_t nchars) nogil:
+    # Byte offset nchars characters past the byte offset start.
+    cdef Py_ssize_t i = start
+    while nchars > 0 and i < size:
+        i += 1
+        while i < size and (s[i] & 0xC0) == 0x80:
+            i += 1
+        nchars -= 1
+    return i
+
+cdef inline Py_ssize_t char_to_byte_offset(const char* s, Py_ssize_t size,
+                                           Py_ssize_t offset, int kind) nogil:
+    if kind != UNICODE_INPUT or offset <= 0:
+        return offset
+    return utf8_skip(s, size, 0, offset)
+
+cdef Py_ssize_t count_matches(RE2* re_pattern, StringPiece text, int pos,
+                              int size, int kind) nogil:
+    # Count the non-overlapping matches in text[pos:size], stepping over
+    # empty matches the same way _finditer does. Only the span of the
+    # whole match is requested.
+    cdef StringPiece match
+    cdef Py_ssize_t count = 0
+    cdef int match_end
+    while re_pattern.Match(text, pos, size, UNANCHORED, &match, 1):
+        count += 1
+        match_end = match.data() - text.data() + match.length()
+        if match.length() == 0:
+            if match_end >= size:
+                break
+            if kind == BYTES_INPUT:
+                pos = match_end + 1
+            else:
+                pos = utf8_skip(text.data(), size, match_end, 1)
+        else:
+            pos = match_end
+    return count
+
+cdef int next_split(RE2* re_pattern, StringPiece text, int* search_pos,
+                    int kind, StringPiece* matches, int nmatch) nogil:
+    # Find the next match at or after search_pos[0] and move search_pos on
+    # as _finditer does: to the end of the match, or one character past an
+    # empty one. Empty matches split the text too, as with re 3.7+.
+    cdef int size = text.length()
+    cdef int match_end
+    if search_pos[0] > size or not re_pattern.Match(
+            text, search_pos[0], size, UNANCHORED, matches, nmatch):
+        return 0
+    match_end = matches[0].data() - text.data() + matches[0].length()
+    if matches[0].length() > 0:
+        search_pos[0] = match_end
+    elif match_end >= size:
+        search_pos[0] = size + 1
+    elif kind == BYTES_INPUT:
+        search_pos[0] = match_end + 1
+    else:
+        search_pos[0] = utf8_skip(text.data(), size, match_end, 1)
+    return 1
+
+cdef void split_pieces(RE2* re_pattern, StringPiece text, int kind,
+                       int maxsplit, StringPiece* matches, int nmatch,
+                       vector[StringPiece]* pieces) nogil:
+    # Collect the pieces of text split by the pattern: the text before
+    # each match followed by its groups, then the rest of the text.
+    # Groups that did not participate have a NULL data pointer.
+    cdef const char* start = text.data()
+    cdef int pos = 0
+    cdef int search_pos = 0
+    cdef int num_split = 0
+    cdef int i
+    while ((not maxsplit or num_split < maxsplit) and
+           next_split(re_pattern, text, &search_pos, kind, matches, nmatch)):
+        pieces.push_back(StringPiece(start + pos,
+                                     matches[0].data() - start - pos))
+        for i in range(1, nmatch):
+            pieces.push_back(matches[i])
+        pos = matches[0].data() - start + matches[0].length()
+        num_split += 1
+    pieces.push_back(StringPiece(start + pos, text.length() - pos))
+
+cdef void grep_lines(RE2* re_pattern, RE2* line_filter, const char* data,
+                     int size, bint invert, vector[int]* found) nogil:
+    # Append the number, start and end of every line of data that the
+    # pattern matches on its own, or with invert does not match, to found.
+    # When there is a line filter, one search with it finds the next line
+    # the pattern may match, and the lines before it are not searched.
+    cdef StringPiece text = StringPiece(data, size)
+    cdef StringPiece match
+    cdef const char* newline
+    cdef int start = 0
+    cdef int end
+    cdef int candidate = -1
+    cdef int lineno = 1
+    cdef bint matched
+    while start < size:
+        newline = <const char*>memchr(data + start, b'\n', size - start)
+        end = size if newline == NULL else newline - data
+        if line_filter != NULL and candidate < start:
+            if line_filter.Match(text, start, size, UNANCHORED, &match, 1):
+                candidate = match.data() - data
+            else:
+                candidate = size + 1
+        if line_filter != NULL and candidate > end:
+            matched = False
+        else:
+            matched = re_pattern.Match(StringPiece(data + start, end - start),
+                                       0, end - start, UNANCHORED, NULL, 0)
+        if matched != invert:
+            found.push_back(lineno)
+            found.push_back(start)
+            found.push_back(end)
+        start = end + 1
+        lineno += 1
+
+cdef inline int next_search_pos(const char* data, int size,
+                                 StringPiece* match, int kind) nogil:
+    # Where to search from after match, the same way _finditer steps over
+    # empty matches. Past the end of the text when the scan is over.
+    cdef int match_end = match.data() - data + match.length()
+    if match.length() > 0:
+        return match_end
+    if match_end >= size:
+        return size + 1
+    if kind == BYTES_INPUT:
+        return match_end + 1
+    return utf8_skip(data, size, match_end, 1)
+
+cdef struct ScanChunk:
+    # Matches starting in [start, end) belong to this chunk. Searches stop
+    # at limit, which is the end of the text unless the caller gave a
+    # maximum match length.
+    int start
+    int end
+    int limit
+    # The search position after the last match found in the chunk.
+    int next_pos
+    # The nmatch groups of each match found, one after the other.
+    vector[StringPiece]* found
+
+cdef struct ParallelScan:
+    RE2* re_pattern
+    const char* data
+    int size
+    int kind
+    int nmatch
+    ScanChunk* chunks
+
+cdef void scan_chunk(void* arg, int index) nogil:
+    # Find the matches of one chunk, scanning as _finditer would if it
+    # started at the beginning of the chunk.
+    cdef ParallelScan* scan = <ParallelScan*>arg
+    cdef ScanChunk* chunk = &scan.chunks[index]
+    cdef StringPiece text = StringPiece(scan.data, scan.size)
+    cdef vector[StringPiece] vec
+    cdef int pos = chunk.start
+    cdef int i
+    vec.resize(scan.nmatch)
+    while pos <= chunk.limit and scan.re_pattern.Match(text, pos,
+            chunk.limit, UNANCHORED, vec.data(), scan.nmatch):
+        if vec[0].data() - scan.data >= chunk.end:
+            break
+        for i in range(scan.nmatch):
+            chunk.found.push_back(vec[i])
+        pos = next_search_pos(scan.data, scan.size, &vec[0], scan.kind)
+    chunk.next_pos = pos
+
+cdef struct CompileJob:
+    const char* source
+    int length
+    RE2* re_pattern
+
+cdef struct ParallelCompile:
+    const Options* opts
+    CompileJob* jobs
+    int njobs
+    int nthreads
+
+cdef void compile_jobs(void* arg, int index) nogil:
+    # Build the programs of every nthreads-th job, starting at index.
+    cdef ParallelCompile* work = <ParallelCompile*>arg
+    cdef CompileJob* job
+    cdef int i = index
+    while i < work.njobs:
+        job = &work.jobs[i]
+        job.re_pattern = new RE2(StringPiece(job.source, job.length),
+                                 work.opts[0])
+        i += work.nthreads
+
+cdef inline object findall_item(const StringPiece* groups, int ngroups,
+                                int kind, object empty):
+    # The findall() result for one match, as built by _finditer.
+    cdef int i
+    if ngroups > 1:
+        return tuple([empty if groups[i].data() == NULL else
+                      slice_result(groups[i].data(), groups[i].length(), kind)
+                      for i in range(1, ngroups + 1)])
+    if groups[ngroups].data() == NULL:
+        return None
+    return slice_result(groups[ngroups].data(), groups[ngroups].length(), kind)
+
+cdef struct TemplateItem:
+    # A group to insert, or -1 for literal text at literals[start:start+length].
+    int group
+    size_t start
+    size_t length
+
+cdef class Template:
+    """
+    A replacement template parsed into literal text and group references.
+    Parsed once per pattern by Pattern._template() and then expanded
+    without the GIL by Match.expand, sub and subn.
+    """
+    cdef vector[TemplateItem] items
+    cdef cpp_string literals
+    cdef int max_group
+    cdef size_t literal_start
+
+    cdef void _flush(self):
+        cdef TemplateItem item
+        if self.literals.length() > self.literal_start:
+            item.group = -1
+            item.start = self.literal_start
+            item.length = self.literals.length() - self.literal_start
+            self.items.push_back(item)
+            self.literal_start = self.literals.length()
+
+    cdef void _add_group(self, int group):
+        cdef TemplateItem item
+        self._flush()
+        item.group = group
+        item.start = 0
+        item.length = 0
+        self.items.push_back(item)
+        if group > self.max_group:
+            self.max_group = group
+
+    cdef void _add_char(self, int value, bint utf8):
+        if utf8 and value >= 0x80:
+            self.literals.push_back(<char>(0xC0 | (value >> 6)))
+            self.literals.push_back(<char>(0x80 | (value & 0x3F)))
+        else:
+            self.literals.push_back(<char>value)
+
+cdef inline bint is_digit(char c) nogil:
+    return c >= b'0' and c <= b'9'
+
+cdef inline bint is_octdigit(char c) nogil:
+    return c >= b'0' and c <= b'7'
+
+cdef Template compile_template(Pattern pattern, object template):
+    # Parse template with the syntax of re: \1 to \99 and \g<name> or
+    # \g<number> refer to groups, \0 and three digit escapes are octal, and
+    # the escapes known to Python strings are translated. Other escapes of
+    # ASCII letters are errors, and any other escape is kept as written.
+    cdef bytes encoded
+    cdef bint utf8 = PyUnicode_Check(template)
+    cdef const char* s
+    cdef Py_ssize_t n, i = 0, end
+    cdef char c
+    cdef int group, value
+    cdef Template tmpl = Template.__new__(Template)
+    cdef cpp_map[cpp_string, int].const_iterator it
+
+    if utf8:
+        encoded = (<unicode>template).encode('utf8')
+    elif is_bytes(template):
+        encoded = template
+    else:
+        raise TypeError("expected string template")
+    s = encoded
+    n = len(encoded)
+    tmpl.literals.reserve(n)
+
+    while i < n:
+        c = s[i]
+        i += 1
+        if c != b'\\':
+            tmpl.literals.push_back(c)
+            continue
+        if i == n:
+            raise RegexError("bad escape (end of pattern)")
+        c = s[i]
+        i += 1
+        if c == b'g':
+            if i == n or s[i] != b'<':
+                raise RegexError("missing <")
+            end = encoded.find(b'>', i + 1)
+            if end < 0:
+                raise RegexError("missing >, unterminated name")
+            name = encoded[i + 1:end]
+            i = end + 1
+            if not name:
+                raise RegexError("missing group name")
+            decoded = name.decode('utf8' if utf8 else 'latin-1')
+            if name.isdigit():
+                group = int(name)
+            elif not _GROUP_NAME.match(decoded):
+                raise RegexError("bad character in group name %r" % decoded)
+            else:
+                it = pattern.re_pattern.NamedCapturingGroups().const_find(name)
+                if it == pattern.re_pattern.NamedCapturingGroups().const_end():
+                    raise IndexError("unknown group name %r" % decoded)
+                group = deref(it).second
+        elif c == b'0':
+            value = 0
+            if i < n and is_octdigit(s[i]):
+                value = s[i] - c'0'
+                i += 1
+                if i < n and is_octdigit(s[i]):
+                    value = value * 8 + s[i] - c'0'
+                    i += 1
+            tmpl._add_char(value, utf8)
+            continue
+        elif is_digit(c):
+            group = c - c'0'
+            if i < n and is_digit(s[i]):
+                if (is_octdigit(c) and is_octdigit(s[i]) and i + 1 < n and
+                        is_octdigit(s[i + 1])):
+                    value = (group * 8 + s[i] - c'0') * 8 + s[i + 1] - c'0'
+                    i += 2
+                    if value > 0o377:
+                        raise RegexError("octal escape value \\%s outside "
+                                         "of range 0-0o377" % (
+                                             encoded[i - 3:i].decode('ascii')))
+                    tmpl._add_char(value, utf8)
+                    continue
+                group = group * 10 + s[i] - c'0'
+                i += 1
+        else:
+            if c == b'n':
+                tmpl.literals.push_back(b'\n')
+            elif c == b't':
+                tmpl.literals.push_back(b'\t')
+            elif c == b'r':
+                tmpl.literals.push_back(b'\r')
+            elif c == b'f':
+                tmpl.literals.push_back(b'\f')
+            elif c == b'v':
+                tmpl.literals.push_back(b'\v')
+            elif c == b'a':
+                tmpl.literals.push_back(b'\a')
+            elif c == b'b':
+                tmpl.literals.push_back(b'\b')
+            elif c == b'\\':
+                tmpl.literals.push_back(b'\\')
+            elif b'a' <= c <= b'z' or b'A' <= c <= b'Z':
+                raise RegexError("bad escape \\%s" % chr(c))
+            else:
+                tmpl.literals.push_back(b'\\')
+                tmpl.literals.push_back(c)
+            continue
+        if group > pattern.ngroups:
+            raise RegexError("invalid group reference %d" % group)
+        tmpl._add_group(group)
+    tmpl._flush()
+    return tmpl
+
+cdef void expand_template(Template tmpl, const StringPiece* vec,
+                          cpp_string* out) nogil:
+    # Append the expansion of tmpl for the groups in vec to out. Groups
+    # that did not participate in the match expand to nothing.
+    cdef size_t i
+    cdef TemplateItem* item
+    cdef const char* literals = tmpl.literals.data()
+    for i in range(tmpl.items.size()):
+        item = &tmpl.items[i]
+        if item.group < 0:
+            out.append(literals + item.start, item.length)
+        elif vec[item.group].data() != NULL:
+            out.append(vec[item.group].data(), vec[item.group].length())
+
+cdef int replace_matches(RE2* re_pattern, StringPiece text, Template tmpl,
+                         StringPiece* vec, int nvec, int count, int kind,
+                         cpp_string* out) nogil:
+    # Append text to out with up to count (0 for all) matches replaced by
+    # the expansion of tmpl, and return the number of replacements. This
+    # follows RE2::GlobalReplace, but reads the subject in place instead of
+    # from a copy, and steps over whole characters for unicode input.
+    cdef const char* start = text.data()
+    cdef const char* p = start
+    cdef const char* ep = p + text.length()
+    cdef const char* next_p
+    cdef int num_repl = 0
+    while p <= ep:
+        if count and num_repl >= count:
+            break
+        if not re_pattern.Match(text, p - start, text.length(), UNANCHORED,
+                                vec, nvec):
+            break
+        if p < vec[0].data():
+            out.append(p, vec[0].data() - p)
+        expand_template(tmpl, vec, out)
+        p = vec[0].data() + vec[0].length()
+        num_repl += 1
+        if vec[0].length() == 0:
+            # Search again one character on, as finditer does, so that an
+            # empty match may still follow a non-empty one.
+            if p >= ep:
+                break
+            if kind == BYTES_INPUT:
+                next_p = p + 1
+            else:
+                next_p = start + utf8_skip(start, text.length(), p - start, 1)
+            out.append(p, next_p - p)
+            p = next_p
+    if p < ep:
+        out.append(p, ep - p)
+    return num_repl
+
 cdef class Match:
     cdef StringPiece* matches
-    cdef const cpp_map[cpp_string, int]* named_groups
 
     cdef int _lastindex
     cdef int nmatches
     cdef int _pos
     cdef int _endpos
     cdef object match_string
+    cdef object _input
+    cdef const char* _c_str
+    cdef int _kind
+    cdef bint _str_names
+    # A byte offset into the subject with its known character offset,
+    # at or before the start of the match. Only used for UNICODE_INPUT.
+    cdef Py_ssize_t _base_byte
+    cdef Py_ssize_t _base_char
+    # Added to the spans of a match found in a window of a stream.
+    cdef Py_ssize_t _offset
     cdef object _pattern_object
     cdef tuple _groups
     cdef tuple _spans
@@ -80,6 +582,9 @@ cdef class Match:
         self._groups = None
         self._pos = 0
         self._endpos = -1
+        self._kind = BYTES_INPUT
+        self._base_byte = 0
+        self._base_char = 0
         self.matches = new_StringPiece_array(num_groups + 1)
         self.nmatches = num_groups
         self._pattern_object = pattern_object
@@ -130,7 +635,8 @@ cdef class Match:
                         if cur_end > last_end:
                             last_end = cur_end
                             self._lastindex = i
-                groups.append(self.matches[i].data()[:self.matches[i].length()])
+                groups.append(slice_result(self.matches[i].data(),
+                                           self.matches[i].length(), self._kind))
             # end else
         # end for i
         self._groups = tuple(groups)
@@ -141,6 +647,14 @@ cdef class Match:
             return tuple([g or default for g in self._groups[1:]])
         return self._groups[1:]
 
+    cdef object _group_name(self, name):
+        # Group names have the type of the pattern, but either is accepted.
+        if self._str_names and is_bytes(name):
+            return (<bytes>name).decode('utf8')
+        elif not self._str_names and PyUnicode_Check(name):
+            return (<unicode>name).encode('utf8')
+        return name
+
     def group(self, *args):
         if len(args) > 1:
             return tuple([self.group(i) for i in args])
@@ -153,8 +667,8 @@ cdef class Match:
 
         self.init_groups()
 
-        if is_bytes(groupnum):
-            return self.groupdict()[groupnum]
+        if is_bytes(groupnum) or PyUnicode_Check(groupnum):
+            return self.groupdict()[self._group_name(groupnum)]
 
         idx = groupnum
 
@@ -166,21 +680,32 @@ cdef class Match:
         if self._spans is not None:
             return
 
-        cdef int start, end
-        cdef char * s = self.match_string
+        cdef Py_ssize_t start, end
+        cdef Py_ssize_t match_start_byte = 0, match_start_char = 0
+        cdef const char * s = self._c_str
         cdef StringPiece * piece
 
+        if self._kind == UNICODE_INPUT:
+            # Every group lies inside the overall match, so translate the
+            # match start once and count the groups from there.
+            match_start_byte = self.matches[0].data() - s
+            match_start_char = self._base_char + utf8_char_count(
+                s + self._base_byte, match_start_byte - self._base_byte)
+
         spans = []
         for i in range(self.nmatches):
             if self.matches[i].data() == NULL:
                 spans.append((-1, -1))
             else:
                 piece = &self.matches[i]
-                if piece.data() == NULL:
-                    return (-1, -1)
                 start = piece.data() - s
-                end = start + piece.length()
-                spans.append((start, end))
+                if self._kind == UNICODE_INPUT:
+                    start = match_start_char + utf8_char_count(
+                        s + match_start_byte, start - match_start_byte)
+                    end = start + utf8_char_count(piece.data(), piece.length())
+                else:
+                    end = start + piece.length()
+                spans.append((start + self._offset, end + self._offset))
 
         self._spans = tuple(spans)
 
@@ -190,29 +715,30 @@ cdef class Match:
                 self._make_spans()
             return self._spans
 
-    def expand(self, bytes template):
-        # TODO - This can be optimized to work a bit faster in C.
-        # Expand a template with groups
-        items = template.split(b'\\')
-        for i, item in enumerate(items[1:]):
-            if item[0].isdigit():
-                # Number group
-                if item[0] == b'0'[0]:
-                    items[i + 1] = b'\x00' + item[1:]
-                else:
-                    items[i + 1] = self.group(int(item[0])) + item[1:]
-            elif item[:2] == b'g<' and b'>' in item:
-                # This is a named group
-                name, rest = item[2:].split(b'>', 1)
-                items[i + 1] = self.group(name) + rest
-            else:
-                # This isn't a template at all
-                items[i + 1] = b'\\' + item
-        return b''.join(items)
+    def expand(self, template):
+        """
+        expand(template) --> string
+        Return the string obtained by doing backslash substitution on the
+        template, as done by the sub() method.
+        """
+        cdef Template tmpl = (<Pattern>self._pattern_object)._template(
+            template, self._kind)
+        cdef cpp_string out
+        expand_template(tmpl, self.matches, &out)
+        if PyUnicode_Check(template):
+            return out.data()[:out.length()].decode('utf8')
+        return out.data()[:out.length()]
+
+    cdef const cpp_map[cpp_string, int]* _group_map(self):
+        # Looked up through the pattern each time, since trim() replaces
+        # its RE2 object.
+        return addressof((<Pattern>self._pattern_object).re_pattern
+                         .NamedCapturingGroups())
 
     def groupdict(self):
         #cdef _re2.stringintmapiterator it
         cdef cpp_map[cpp_string, int].const_iterator it
+        cdef const cpp_map[cpp_string, int]* named_groups
         cdef dict result = {}
         cdef dict indexes = {}
 
@@ -222,10 +748,14 @@ cdef class Match:
             return self._named_groups
 
         self._named_groups = result
-        it = self.named_groups.const_begin()
-        while it != self.named_groups.const_end():
-            indexes[cpp_to_pystring(deref(it).first)] = deref(it).second
-            result[cpp_to_pystring(deref(it).first)] = self._groups[deref(it).second]
+        named_groups = self._group_map()
+        it = named_groups.const_begin()
+        while it != named_groups.const_end():
+            name = cpp_to_pystring(deref(it).first)
+            if self._str_names:
+                name = name.decode('utf8')
+            indexes[name] = deref(it).second
+            result[name] = self._groups[deref(it).second]
             inc(it)
 
         self._named_groups = result
@@ -246,6 +776,7 @@ cdef class Match:
             return self._spans[group]
         else:
             self.groupdict()
+            group = self._group_name(group)
             if group not in self._named_indexes:
                 raise IndexError("no such group")
             return self._spans[self._named_indexes[group]]
@@ -263,25 +794,54 @@ cdef class Match:
         def __get__(self):
             self.init_groups()
             cdef cpp_map[cpp_string, int].const_iterator it
+            cdef const cpp_map[cpp_string, int]* named_groups
 
             if self._lastindex < 1:
                 return None
 
-            it = self.named_groups.const_begin()
-            while it != self.named_groups.const_end():
+            named_groups = self._group_map()
+            it = named_groups.const_begin()
+            while it != named_groups.const_end():
                 if deref(it).second == self._lastindex:
+                    if self._str_names:
+                        return cpp_to_pystring(deref(it).first).decode('utf8')
                     return cpp_to_pystring(deref(it).first)
                 inc(it)
 
             return None
 
 
+cdef class Replica:
+    # A copy of the program of a pattern for one thread, so that threads do
+    # not contend for the locks of a shared DFA cache.
+    cdef RE2* re_pattern
+
+    def __dealloc__(self):
+        del self.re_pattern
+
+
 cdef class Pattern:
     cdef RE2* re_pattern
     cdef int ngroups
     cdef int _flags
+    cdef bint _unicode
+    cdef object _templates
     cdef public object pattern
     cdef object __weakref__
+    # Threads matching without the GIL right now, which trim() waits out.
+    cdef int _busy
+    # Matches run so far, and their count at the last trim_idle() sweep and
+    # at the last trim().
+    cdef Py_ssize_t _uses
+    cdef Py_ssize_t _swept_uses
+    cdef Py_ssize_t _trimmed_uses
+    cdef double _last_used
+    # With per_thread, the replicas of the program made for the threads
+    # other than the one that compiled the pattern.
+    cdef object _replicas
+    cdef object _owner
+    # The filter of grep_lines(), False when there is none.
+    cdef object _lines
 
     property flags:
         def __get__(self):
@@ -291,56 +851,162 @@ cdef class Pattern:
         def __get__(self):
             return self.ngroups
 
+    property program_size:
+        def __get__(self):
+            return self.re_pattern.ProgramSize()
+
+    property per_thread:
+        def __get__(self):
+            return self._replicas is not None
+
     def __dealloc__(self):
         del self.re_pattern
 
-    cdef _search(self, bytes in_string, int pos, int endpos, re2_Anchor anchoring):
+    cdef inline RE2* _enter(self) except NULL:
+        # Called with the GIL held before matching without it. Return the
+        # RE2 object the current thread matches with.
+        self._busy += 1
+        self._uses += 1
+        if self._replicas is None or _get_ident() == self._owner:
+            return self.re_pattern
+        try:
+            return self._replica()
+        except:
+            self._busy -= 1
+            raise
+
+    cdef inline void _leave(self):
+        self._busy -= 1
+
+    cdef RE2* _replica(self) except NULL:
+        # The RE2 object of the current thread, built on its first match.
+        cdef Replica replica = getattr(self._replicas, 'replica', None)
+        cdef cpp_string source
+        if replica is None:
+            replica = Replica()
+            source = self.re_pattern.pattern()
+            with nogil:
+                replica.re_pattern = new RE2(
+                    StringPiece(source.data(), source.length()),
+                    self.re_pattern.options())
+            self._replicas.replica = replica
+        return replica.re_pattern
+
+    def trim(self):
+        """
+        trim() --> bool
+        Free the DFA state caches that matching has built up, by compiling
+        the pattern again, and drop the replicas of a per_thread pattern.
+        They are built afresh on the next match. Return
+        False, leaving the caches alone, while another thread is matching
+        with the pattern.
+        """
+        cdef RE2* re_pattern
+        cdef cpp_string source
+        if self._busy:
+            return False
+        if self._uses == self._trimmed_uses:
+            # Not used since it was compiled or last trimmed.
+            return True
+        source = self.re_pattern.pattern()
+        # Keep other trim() calls off the program while the GIL is released.
+        self._busy += 1
+        try:
+            with nogil:
+                re_pattern = new RE2(StringPiece(source.data(),
+                                                 source.length()),
+                                     self.re_pattern.options())
+        finally:
+            self._busy -= 1
+        if self._busy:
+            # Another thread started matching while the GIL was released.
+            del re_pattern
+            return False
+        del self.re_pattern
+        self.re_pattern = re_pattern
+        if self._replicas is not None:
+            self._replicas = threading.local()
+        self._trimmed_uses = self._uses
+        return True
+
+    cdef Template _template(self, template, int kind):
+        # Parsed replacement templates are kept per pattern, since group
+        # names are resolved against it, least recently used first. Like
+        # re, reject a template of another type than the subject of kind.
+        cdef Template tmpl
+        if PyUnicode_Check(template):
+            if kind == BYTES_INPUT:
+                raise TypeError("expected a bytes-like object, str found")
+        elif kind != BYTES_INPUT and is_bytes(template):
+            raise TypeError("expected str instance, bytes found")
+        if self._templates is None:
+            self._templates = collections.OrderedDict()
+        tmpl = self._templates.pop(template, None)
+        if tmpl is None:
+            tmpl = compile_template(self, template)
+            if len(self._templates) >= _MAXCACHE_TEMPLATES:
+                self._templates.popitem(last=False)
+        self._templates[template] = tmpl
+        return tmpl
+
+    cdef Match _new_match(self, object in_string, object keeper,
+                          const char* c_str, int kind):
+        cdef Match m = Match(self, self.ngroups + 1)
+        m.nmatches = self.ngroups + 1
+        m.match_string = in_string
+        m._input = keeper
+        m._c_str = c_str
+        m._kind = kind
+        m._str_names = self._unicode
+        return m
+
+    cdef _search(self, object in_string, int pos, int endpos, re2_Anchor anchoring):
         """
         Scan through in_string looking for a match, and return a corresponding
         Match instance. Return None if no position in the in_string matches.
         """
-        cdef Py_ssize_t size
+        cdef RE2* re_pattern
+        cdef Py_ssize_t size, total_size
+        cdef Py_ssize_t byte_pos
         cdef int result
+        cdef int kind
         cdef char* cstring
-        cdef int encoded = 0
+        cdef object keeper
         #cdef StringPiece* sp
         cdef StringPiece sp
-        cdef Match m = Match(self, self.ngroups + 1)
+        cdef Match m
 
-        encoded = pystring_to_cstr(in_string, &cstring, &size)
-        if encoded == -1:
-            raise TypeError("expected string or buffer")
+        keeper = input_to_cstr(in_string, &cstring, &size, &kind)
+        total_size = size
+        if kind == UNICODE_INPUT:
+            total_size = len(in_string)
 
         if endpos >= 0 and endpos <= pos:
             return None
 
-        if endpos >= 0 and endpos < size:
-            size = endpos
+        if endpos >= 0 and endpos < total_size:
+            size = char_to_byte_offset(cstring, size, endpos, kind)
 
-        if pos > size:
+        if pos > total_size:
             return None
 
-        #sp = new StringPiece(cstring, size)
-        #try:
-        #    with nogil:
-        #        result = self.re_pattern.Match(sp[0], <int>pos, <int>size, 
-        #                                anchoring, m.matches, self.ngroups + 1)
-        #finally:
-        #    del sp
+        byte_pos = char_to_byte_offset(cstring, size, pos, kind)
 
+        m = self._new_match(in_string, keeper, cstring, kind)
         sp = StringPiece(cstring, size)
+        re_pattern = self._enter()
         with nogil:
-            result = self.re_pattern.Match(sp, <int>pos, <int>size, 
+            result = re_pattern.Match(sp, <int>byte_pos, <int>size, 
                                     anchoring, m.matches, self.ngroups + 1)
+        self._leave()
         if result == 0:
             return None
 
-        m.named_groups = addressof(self.re_pattern.NamedCapturingGroups())
-        m.nmatches = self.ngroups + 1
-        m.match_string = in_string
+        m._base_byte = byte_pos
+        m._base_char = pos
         m._pos = pos
         if endpos == -1:
-            m._endpos = len(in_string)
+            m._endpos = total_size
         else:
             m._endpos = endpos
         return m
@@ -360,6 +1026,174 @@ cdef class Pattern:
         """
         return self._search(in_string, pos, endpos, ANCHOR_START)
 
+    def fullmatch(self, in_string, int pos=0, int endpos=-1):
+        """
+        Matches only if the whole string matches the pattern.
+        """
+        return self._search(in_string, pos, endpos, ANCHOR_BOTH)
+
+    cdef list _search_many(self, strings, re2_Anchor anchoring):
+        """
+        Run the pattern over every string of a list or tuple in a single
+        GIL-free loop, and return a list of Match instances or None.
+        """
+        cdef RE2* re_pattern
+        cdef Py_ssize_t n, i
+        cdef int j
+        cdef int nmatch = self.ngroups + 1
+        cdef char* cstring
+        cdef Py_ssize_t size
+        cdef int kind
+        cdef vector[StringPiece] texts
+        cdef vector[int] kinds
+        cdef vector[int] found
+        cdef StringPiece* matches
+        cdef list keepers
+        cdef list results
+        cdef Match m
+
+        if not isinstance(strings, (list, tuple)):
+            raise TypeError("expected a list or tuple of strings")
+        n = len(strings)
+        keepers = [None] * n
+        texts.reserve(n)
+        kinds.reserve(n)
+        for i in range(n):
+            keepers[i] = input_to_cstr(strings[i], &cstring, &size, &kind)
+            texts.push_back(StringPiece(cstring, size))
+            kinds.push_back(kind)
+        found.resize(n)
+
+        matches = new_StringPiece_array(n * nmatch)
+        try:
+            re_pattern = self._enter()
+            with nogil:
+                for i in range(n):
+                    found[i] = re_pattern.Match(texts[i], 0,
+                                    texts[i].length(), anchoring,
+                                    matches + i * nmatch, nmatch)
+            self._leave()
+
+            results = [None] * n
+            for i in range(n):
+                if not found[i]:
+                    continue
+                m = self._new_match(strings[i], keepers[i],
+                                    texts[i].data(), kinds[i])
+                for j in range(nmatch):
+                    m.matches[j] = matches[i * nmatch + j]
+                if kinds[i] == UNICODE_INPUT:
+                    m._endpos = len(strings[i])
+                else:
+                    m._endpos = texts[i].length()
+                results[i] = m
+        finally:
+            delete_StringPiece_array(matches)
+        return results
+
+    def search_many(self, strings):
+        """
+        search_many(strings) --> list
+        Return [self.search(s) for s in strings], for a list or tuple of
+        strings, releasing the GIL once for all of the searches.
+        """
+        return self._search_many(strings, UNANCHORED)
+
+    def match_many(self, strings):
+        """
+        match_many(strings) --> list
+        Return [self.match(s) for s in strings], for a list or tuple of
+        strings, releasing the GIL once for all of the matches.
+        """
+        return self._search_many(strings, ANCHOR_START)
+
+    def fullmatch_many(self, strings):
+        """
+        fullmatch_many(strings) --> list
+        Return [self.fullmatch(s) for s in strings], for a list or tuple of
+        strings, releasing the GIL once for all of the matches.
+        """
+        return self._search_many(strings, ANCHOR_BOTH)
+
+    def test(self, in_string, int pos=0, int endpos=-1):
+        """
+        Return True if the pattern matches anywhere in the string, like
+        bool(search(...)). No submatches are requested from RE2, so only
+        the forward DFA runs and no Match object is built.
+        """
+        cdef RE2* re_pattern
+        cdef Py_ssize_t size, total_size
+        cdef Py_ssize_t byte_pos
+        cdef int result
+        cdef int kind
+        cdef char* cstring
+        cdef object keeper
+        cdef StringPiece sp
+
+        keeper = input_to_cstr(in_string, &cstring, &size, &kind)
+        total_size = size
+        if kind == UNICODE_INPUT:
+            total_size = len(in_string)
+
+        if endpos >= 0 and endpos <= pos:
+            return False
+
+        if endpos >= 0 and endpos < total_size:
+            size = char_to_byte_offset(cstring, size, endpos, kind)
+
+        if pos > total_size:
+            return False
+
+        byte_pos = char_to_byte_offset(cstring, size, pos, kind)
+
+        sp = StringPiece(cstring, size)
+        re_pattern = self._enter()
+        with nogil:
+            result = re_pattern.Match(sp, <int>byte_pos, <int>size,
+                                    UNANCHORED, NULL, 0)
+        self._leave()
+        return result != 0
+
+    def possible_match_range(self, int maxlen=10):
+        """
+        possible_match_range([maxlen = 10]) --> (min, max) or None
+        Return byte strings min and max of at most maxlen bytes such that
+        min <= s <= max for the UTF-8 bytes of every string s that the
+        whole pattern matches, as fullmatch() does. Return None when no
+        range can be computed.
+        """
+        cdef cpp_string pmin, pmax
+        if not self.re_pattern.PossibleMatchRange(&pmin, &pmax, maxlen):
+            return None
+        return (cpp_to_pystring(pmin), cpp_to_pystring(pmax))
+
+    def filter_sorted(self, seq, int maxlen=10):
+        """
+        filter_sorted(seq[, maxlen = 10]) --> list
+        Return the items of the sorted sequence seq that the whole pattern
+        matches. Only the slice of seq within possible_match_range() is
+        run through the pattern, found by bisection.
+        """
+        cdef Py_ssize_t lo, hi
+        bounds = self.possible_match_range(maxlen)
+        if bounds is None:
+            candidates = list(seq)
+        elif self._unicode:
+            # UTF-8 preserves the order of code points, so the bounds apply
+            # to str keys through their encoding. The lower bound may end
+            # in a partial character, which is dropped.
+            lo = bisect.bisect_left(seq, bounds[0].decode('utf8', 'ignore'))
+            hi = lo
+            while hi < len(seq) and (<unicode>seq[hi]).encode('utf8') <= bounds[1]:
+                hi += 1
+            candidates = list(seq[lo:hi])
+        else:
+            lo = bisect.bisect_left(seq, bounds[0])
+            hi = bisect.bisect_right(seq, bounds[1], lo)
+            candidates = list(seq[lo:hi])
+        return [item for item, m in zip(candidates,
+                                        self.fullmatch_many(candidates)) if m]
+
     cdef _print_pattern(self):
         cdef cpp_string* s
         s = <cpp_string*>addressofs(self.re_pattern.pattern())
@@ -367,96 +1201,137 @@ cdef class Pattern:
         sys.stdout.flush()
 
 
-    cdef _finditer(self, bytes in_string, int pos=0, int endpos=-1, int as_match=0):
-        cdef Py_ssize_t size
+    cdef _finditer(self, object in_string, int pos=0, int endpos=-1, int as_match=0):
+        cdef RE2* re_pattern
+        cdef Py_ssize_t size, total_size
+        cdef Py_ssize_t byte_pos, start_byte
+        cdef Py_ssize_t match_end
         cdef int result
+        cdef int kind
         cdef char* in_c_str
         #cdef StringPiece* sp
         cdef StringPiece sp
         cdef Match m
         cdef list resultlist = []
-        cdef int encoded = 0
-
-        encoded = pystring_to_cstr(in_string, &in_c_str, &size)
-        if encoded == -1:
-            raise TypeError("expected string or buffer")
-
-        if endpos != -1 and endpos < size:
-            size = endpos
-
-        #sp = new StringPiece(in_c_str, size)
-        #try:
-        #    while True:
-        #        m = Match(self, self.ngroups + 1)
-        #        with nogil:
-        #            result = self.re_pattern.Match(sp[0], <int>pos, <int>size, 
-        #                            UNANCHORED, m.matches, self.ngroups + 1)
-        #        if result == 0:
-        #            break
-        #        m.named_groups = addressof(self.re_pattern.NamedCapturingGroups())
-        #        m.nmatches = self.ngroups + 1
-        #        m.match_string = in_string
-        #        m._pos = pos
-        #        if endpos == -1:
-        #            m._endpos = len(in_string)
-        #        else:
-        #            m._endpos = endpos
-        #        if as_match:
-        #            if self.ngroups > 1:
-        #                resultlist.append(m.groups(b""))
-        #            else:
-        #                resultlist.append(m.group(self.ngroups))
-        #        else:
-        #            resultlist.append(m)
-        #        if pos == size:
-        #            break
-        #        # offset the pos to move to the next point
-        #        if m.matches[0].length() == 0:
-        #            pos += 1
-        #        else:
-        #            pos = m.matches[0].data() - in_c_str + m.matches[0].length()
-        #finally:
-        #    del sp
+        cdef object keeper
+        cdef object empty
+
+        keeper = input_to_cstr(in_string, &in_c_str, &size, &kind)
+        total_size = size
+        if kind == UNICODE_INPUT:
+            total_size = len(in_string)
+        empty = b"" if kind == BYTES_INPUT else u""
+
+        if endpos >= 0 and endpos < pos:
+            return resultlist
+
+        if endpos != -1 and endpos < total_size:
+            size = char_to_byte_offset(in_c_str, size, endpos, kind)
+
+        start_byte = byte_pos = char_to_byte_offset(in_c_str, size, pos, kind)
+
         sp = StringPiece(in_c_str, size)
         while True:
-            m = Match(self, self.ngroups + 1)
+            m = self._new_match(in_string, keeper, in_c_str, kind)
+            re_pattern = self._enter()
             with nogil:
-                result = self.re_pattern.Match(sp, <int>pos, <int>size, 
+                result = re_pattern.Match(sp, <int>byte_pos, <int>size, 
                                 UNANCHORED, m.matches, self.ngroups + 1)
+            self._leave()
             if result == 0:
                 break
-            m.named_groups = addressof(self.re_pattern.NamedCapturingGroups())
-            m.nmatches = self.ngroups + 1
-            m.match_string = in_string
+            m._base_byte = start_byte
+            m._base_char = pos
             m._pos = pos
             if endpos == -1:
-                m._endpos = len(in_string)
+                m._endpos = total_size
             else:
                 m._endpos = endpos
             if as_match:
                 if self.ngroups > 1:
-                    resultlist.append(m.groups(b""))
+                    resultlist.append(m.groups(empty))
                 else:
                     resultlist.append(m.group(self.ngroups))
             else:
                 resultlist.append(m)
-            if pos == size:
-                break
             # offset the pos to move to the next point
+            match_end = m.matches[0].data() - in_c_str + m.matches[0].length()
             if m.matches[0].length() == 0:
-                pos += 1
+                if match_end >= size:
+                    break
+                if kind == BYTES_INPUT:
+                    byte_pos = match_end + 1
+                else:
+                    byte_pos = utf8_skip(in_c_str, size, match_end, 1)
             else:
-                pos = m.matches[0].data() - in_c_str + m.matches[0].length()
+                byte_pos = match_end
         # end while
         return resultlist
 
     def finditer(self, string, int pos=0, int endpos=-1):
         """
-        Return all non-overlapping matches of pattern in string as a list
-        of match objects.
+        Return an iterator over all non-overlapping matches of pattern in
+        string. Matches are found lazily, one search per step.
         """
-        # TODO This builds a list and returns its iterator. Probably could be more memory efficient
-        return self._finditer(string, pos, endpos, 0).__iter__()
+        cdef Py_ssize_t size
+        cdef char* in_c_str
+        cdef int kind
+        cdef MatchIterator it = MatchIterator.__new__(MatchIterator)
+
+        it.keeper = input_to_cstr(string, &in_c_str, &size, &kind)
+        it.total_size = size
+        if kind == UNICODE_INPUT:
+            it.total_size = len(string)
+
+        if endpos >= 0 and endpos < pos:
+            it.keeper = None
+            it.done = True
+            return it
+
+        if endpos != -1 and endpos < it.total_size:
+            size = char_to_byte_offset(in_c_str, size, endpos, kind)
+
+        it.pattern = self
+        it.in_string = string
+        it.in_c_str = in_c_str
+        it.kind = kind
+        it.sp = StringPiece(in_c_str, size)
+        it.pos = char_to_byte_offset(in_c_str, size, pos, kind)
+        it.size = size
+        it.start_pos = pos
+        it.endpos = endpos
+        it.base_byte = it.pos
+        it.base_char = pos
+        it.done = pos > it.total_size
+        return it
+
+    def finditer_stream(self, fileobj, int chunk_size=1 << 20,
+                        int max_match_len=1 << 16):
+        """
+        finditer_stream(fileobj[, chunk_size[, max_match_len]]) --> iterator
+        Return an iterator over the matches of pattern in a binary file-like
+        object, read chunk_size bytes at a time, as finditer() would find
+        them in its whole content. Match offsets count from the start of
+        the stream, while match.string only holds the part of the stream
+        the match was found in.
+
+        Up to max_match_len bytes are carried over from one chunk to the
+        next, so that matches across chunk boundaries are found as long as
+        none is longer than that. Memory stays bounded by chunk_size plus
+        max_match_len, whatever the size of the stream.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be greater than 0")
+        if max_match_len < 0:
+            raise ValueError("max_match_len must not be negative")
+        return self._finditer_stream(fileobj, chunk_size, max_match_len)
+
+    def _finditer_stream(self, fileobj, int chunk_size, int max_match_len):
+        cdef StreamScanner scanner = StreamScanner(self, max_match_len)
+        while not scanner.eof:
+            scanner.feed(fileobj.read(chunk_size))
+            for m in scanner:
+                yield m
 
     def findall(self, string, int pos=0, int endpos=-1):
         """
@@ -465,75 +1340,324 @@ cdef class Pattern:
         """
         return self._finditer(string, pos, endpos, 1)
 
-    def split(self, bytes in_string, int maxsplit=0):
+    cdef Pattern _line_filter(self):
+        # The pattern with ^ and $ matching at every newline, which finds
+        # in one search the next line the pattern may match on its own.
+        # None when \A, \z or a cleared m flag could make it miss some.
+        cdef RE2* re_pattern
+        cdef Pattern filter
+        cdef cpp_string source
+        cdef const char* c_str
+        cdef Py_ssize_t length
+        if self._lines is None:
+            self._lines = False
+            source = self.re_pattern.pattern()
+            wrapped = b'(?m:' + cpp_to_pystring(source) + b')'
+            if _UNFILTERED_LINES.search(wrapped):
+                return None
+            c_str = wrapped
+            length = len(wrapped)
+            with nogil:
+                re_pattern = new RE2(StringPiece(c_str, length),
+                                     self.re_pattern.options())
+            if not re_pattern.ok():
+                del re_pattern
+                return None
+            filter = Pattern()
+            filter.pattern = wrapped
+            filter.re_pattern = re_pattern
+            filter.ngroups = re_pattern.NumberOfCapturingGroups()
+            filter._last_used = _monotonic()
+            _patterns.add(filter)
+            self._lines = filter
+        return self._lines or None
+
+    def grep_lines(self, buffer, bint invert=False):
         """
-        split(in_string[, maxsplit = 0]) --> list
-        Split a string by the occurances of the pattern.
+        grep_lines(buffer[, invert]) --> list
+        Return a (line_number, start, end) tuple for every line of buffer
+        that search() would match on its own, or with invert for every line
+        it would not. Lines end at newlines, which they do not include, and
+        are numbered from 1 as grep -n does.
+
+        The whole scan runs without the GIL. Lines that cannot match are
+        skipped by searching the rest of buffer at once, rather than each
+        line in turn.
         """
+        cdef RE2* re_pattern
+        cdef RE2* line_filter = NULL
+        cdef Pattern filter = self._line_filter()
         cdef Py_ssize_t size
-        cdef int num_groups = 1
-        cdef int result
-        cdef int endpos
-        cdef int pos = 0
-        cdef int lookahead = 0
-        cdef int num_split = 0
         cdef char* in_c_str
-        cdef StringPiece* sp
-        cdef StringPiece* matches
-        cdef Match m
-        cdef list resultlist = []
-        cdef int encoded = 0
+        cdef int kind
+        cdef vector[int] found
+        cdef size_t i
+        cdef Py_ssize_t start, end
+        cdef Py_ssize_t base_byte = 0, base_char = 0
+        cdef list result = []
+
+        keeper = input_to_cstr(buffer, &in_c_str, &size, &kind)
+        re_pattern = self._enter()
+        try:
+            if filter is not None:
+                line_filter = filter._enter()
+            with nogil:
+                grep_lines(re_pattern, line_filter, in_c_str, <int>size,
+                           invert, &found)
+        finally:
+            if line_filter != NULL:
+                filter._leave()
+            self._leave()
+
+        for i in range(0, found.size(), 3):
+            start = found[i + 1]
+            end = found[i + 2]
+            if kind == UNICODE_INPUT:
+                # Lines come in order, so count characters from the last.
+                start = base_char + utf8_char_count(in_c_str + base_byte,
+                                                    start - base_byte)
+                base_byte = found[i + 2]
+                end = start + utf8_char_count(in_c_str + found[i + 1],
+                                              base_byte - found[i + 1])
+                base_char = end
+            result.append((found[i], start, end))
+        return result
 
-        if maxsplit < 0:
-            maxsplit = 0
+    def count(self, string, int pos=0, int endpos=-1):
+        """
+        Return the number of non-overlapping matches of pattern in string.
+        This is len(findall(...)) without building the matches, and the
+        whole scan runs without the GIL.
+        """
+        cdef RE2* re_pattern
+        cdef Py_ssize_t size, total_size
+        cdef Py_ssize_t byte_pos
+        cdef Py_ssize_t result
+        cdef int kind
+        cdef char* in_c_str
+        cdef object keeper
+        cdef StringPiece sp
 
-        encoded = pystring_to_cstr(in_string, &in_c_str, &size)
-        if encoded == -1:
-            raise TypeError("expected string or buffer")
+        keeper = input_to_cstr(string, &in_c_str, &size, &kind)
+        total_size = size
+        if kind == UNICODE_INPUT:
+            total_size = len(string)
 
-        matches = new_StringPiece_array(self.ngroups + 1)
-        sp = new StringPiece(in_c_str, size)
-        try:
-            while True:
-                with nogil:
-                    result = self.re_pattern.Match(sp[0], <int>(pos + lookahead), 
-                        <int>size, UNANCHORED, matches, self.ngroups + 1)
-                if result == 0:
-                    break
+        if endpos >= 0 and endpos < pos:
+            return 0
 
-                match_start = matches[0].data() - in_c_str
-                match_end = match_start + matches[0].length()
+        if endpos != -1 and endpos < total_size:
+            size = char_to_byte_offset(in_c_str, size, endpos, kind)
 
-                # If an empty match, just look ahead until you find something
-                if match_start == match_end:
-                    if pos + lookahead == size:
+        if pos > total_size:
+            return 0
+
+        byte_pos = char_to_byte_offset(in_c_str, size, pos, kind)
+
+        sp = StringPiece(in_c_str, size)
+        re_pattern = self._enter()
+        with nogil:
+            result = count_matches(re_pattern, sp, <int>byte_pos, <int>size,
+                                   kind)
+        self._leave()
+        return result
+
+    cdef object _scan_parallel(self, string, max_workers, max_match_len,
+                               bint count_only):
+        cdef RE2* re_pattern
+        cdef Py_ssize_t size
+        cdef char* in_c_str
+        cdef int kind
+        cdef object keeper
+        cdef object empty
+        cdef int nchunks, k, i, n, q, start, end, result
+        cdef int nmatch = 1 if count_only else self.ngroups + 1
+        cdef int max_len = -1
+        cdef bint synced
+        cdef ParallelScan scan
+        cdef vector[ScanChunk] chunks
+        cdef ScanChunk* chunk
+        cdef vector[StringPiece] vec
+        cdef StringPiece text
+        cdef Py_ssize_t total = 0
+        cdef list resultlist = []
+
+        keeper = input_to_cstr(string, &in_c_str, &size, &kind)
+        empty = b"" if kind == BYTES_INPUT else u""
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        if max_workers < 1:
+            raise ValueError("max_workers must be greater than 0")
+        if max_match_len is not None:
+            if max_match_len < 0:
+                raise ValueError("max_match_len must not be negative")
+            max_len = min(max_match_len, size)
+
+        nchunks = max(1, min(max_workers, size // _MIN_PARALLEL_CHUNK))
+        chunks.resize(nchunks)
+        start = 0
+        for k in range(nchunks):
+            if k == nchunks - 1:
+                # Empty matches at the very end belong to the last chunk.
+                end = size + 1
+            else:
+                end = size * (k + 1) // nchunks
+                if kind != BYTES_INPUT:
+                    while end < size and (<unsigned char>in_c_str[end]) & 0xC0 == 0x80:
+                        end += 1
+            chunks[k].start = start
+            chunks[k].end = end
+            chunks[k].limit = size
+            if max_len >= 0 and end + max_len < size:
+                chunks[k].limit = end + max_len
+            chunks[k].found = NULL
+            start = end
+        for k in range(nchunks):
+            chunks[k].found = new vector[StringPiece]()
+
+        scan.data = in_c_str
+        scan.size = size
+        scan.kind = kind
+        scan.nmatch = nmatch
+        scan.chunks = chunks.data()
+        text = StringPiece(in_c_str, size)
+        vec.resize(nmatch)
+
+        scan.re_pattern = re_pattern = self._enter()
+        try:
+            with nogil:
+                run_parallel(nchunks, scan_chunk, &scan)
+
+            # Stitch the chunks together. Each chunk was scanned as if a
+            # match could start right at its beginning. When the previous
+            # match runs past that point, search again from the end of that
+            # match until a match lines up with one the chunk found; from
+            # there on both scans are the same.
+            q = 0
+            for k in range(nchunks):
+                chunk = &chunks[k]
+                n = chunk.found.size() // nmatch
+                i = 0
+                synced = q <= chunk.start
+                while not synced and q <= chunk.limit:
+                    with nogil:
+                        result = re_pattern.Match(text, q, chunk.limit,
+                                        UNANCHORED, vec.data(), nmatch)
+                    if not result or vec[0].data() - in_c_str >= chunk.end:
+                        break
+                    while (i < n and chunk.found[0][i * nmatch].data() <
+                           vec[0].data()):
+                        i += 1
+                    if i < n and chunk.found[0][i * nmatch].data() == vec[0].data():
+                        synced = True
                         break
-                    lookahead += 1
+                    if count_only:
+                        total += 1
+                    else:
+                        resultlist.append(findall_item(vec.data(),
+                                          self.ngroups, kind, empty))
+                    q = next_search_pos(in_c_str, size, &vec[0], kind)
+                if not synced:
                     continue
+                if count_only:
+                    total += n - i
+                else:
+                    for i in range(i, n):
+                        resultlist.append(findall_item(
+                            &chunk.found[0][i * nmatch], self.ngroups,
+                            kind, empty))
+                q = chunk.next_pos
+        finally:
+            self._leave()
+            for k in range(nchunks):
+                del chunks[k].found
 
-                resultlist.append(sp.data()[pos:match_start])
-                if self.ngroups > 0:
-                    for group in range(self.ngroups):
-                        if matches[group + 1].data() == NULL:
-                            resultlist.append(None)
-                        else:
-                            resultlist.append(matches[group + 1].data()[:matches[group + 1].length()])
+        if count_only:
+            return total
+        return resultlist
 
-                # offset the pos to move to the next point
-                pos = match_end
-                lookahead = 0
+    def findall_parallel(self, string, max_workers=None, max_match_len=None):
+        """
+        findall_parallel(string[, max_workers[, max_match_len]]) --> list
+        Return the same list as findall(string), scanning chunks of string
+        on up to max_workers native threads (one per CPU by default).
+
+        Chunks are stitched back together by searching again across their
+        boundaries. If no match of the pattern is longer than max_match_len
+        bytes, passing it stops each thread soon after the end of its chunk,
+        which matters when matches are sparse.
+        """
+        return self._scan_parallel(string, max_workers, max_match_len, False)
 
-                num_split += 1
-                if maxsplit and num_split >= maxsplit:
-                    break
+    def count_parallel(self, string, max_workers=None, max_match_len=None):
+        """
+        count_parallel(string[, max_workers[, max_match_len]]) --> int
+        Return the same number as count(string), scanning chunks of string
+        on up to max_workers native threads, as findall_parallel() does.
+        """
+        return self._scan_parallel(string, max_workers, max_match_len, True)
 
-            resultlist.append(sp.data()[pos:])
+    def split(self, in_string, int maxsplit=0):
+        """
+        split(in_string[, maxsplit = 0]) --> list
+        Split a string by the occurances of the pattern. Empty matches
+        split it too, as with re 3.7+ and like sub().
+        """
+        cdef RE2* re_pattern
+        cdef Py_ssize_t size
+        cdef char* in_c_str
+        cdef int kind
+        cdef size_t i
+        cdef StringPiece* matches
+        cdef vector[StringPiece] pieces
+        cdef list resultlist = []
+        cdef object keeper
+
+        if maxsplit < 0:
+            maxsplit = 0
+
+        keeper = input_to_cstr(in_string, &in_c_str, &size, &kind)
+
+        matches = new_StringPiece_array(self.ngroups + 1)
+        try:
+            re_pattern = self._enter()
+            with nogil:
+                split_pieces(re_pattern, StringPiece(in_c_str, size),
+                             kind, maxsplit, matches, self.ngroups + 1,
+                             &pieces)
+            self._leave()
         finally:
             delete_StringPiece_array(matches)
-            del sp
+
+        for i in range(pieces.size()):
+            if pieces[i].data() == NULL:
+                resultlist.append(None)
+            else:
+                resultlist.append(slice_result(pieces[i].data(),
+                                               pieces[i].length(), kind))
         return resultlist
 
-    def sub(self, repl, bytes in_string, int count=0):
+    def isplit(self, in_string, int maxsplit=0):
+        """
+        isplit(in_string[, maxsplit = 0]) --> iterator
+        Like split(), but return an iterator over the pieces, which are
+        found lazily, one search per match.
+        """
+        cdef Py_ssize_t size
+        cdef char* in_c_str
+        cdef int kind
+        cdef SplitIterator it = SplitIterator.__new__(SplitIterator)
+
+        it.keeper = input_to_cstr(in_string, &in_c_str, &size, &kind)
+        it.pattern = self
+        it.in_c_str = in_c_str
+        it.kind = kind
+        it.sp = StringPiece(in_c_str, size)
+        it.maxsplit = maxsplit if maxsplit > 0 else 0
+        it.matches = new_StringPiece_array(self.ngroups + 1)
+        return it
+
+    def sub(self, repl, in_string, int count=0):
         """
         sub(repl, string[, count = 0]) --> newstring
         Return the string obtained by replacing the leftmost non-overlapping
@@ -541,92 +1665,57 @@ cdef class Pattern:
         """
         return self.subn(repl, in_string, count)[0]
 
-    def subn(self, repl, bytes in_string, int count=0):
+    def subn(self, repl, in_string, int count=0):
         """
         subn(repl, in_string[, count = 0]) --> (newstring, number of subs)
         Return the tuple (new_string, number_of_subs_made) found by replacing
         the leftmost non-overlapping occurrences of pattern with the
         replacement repl.
         """
-        cdef Py_ssize_t repl_size, input_size
-        cdef char* repl_c_str
-        cdef cpp_string* fixed_repl
-        cdef StringPiece* sp
+        cdef RE2* re_pattern
+        cdef Py_ssize_t input_size
+        cdef cpp_string out
+        cdef StringPiece text
+        cdef StringPiece* vec
+        cdef int nvec
         cdef char* input_c_str
-        cdef cpp_string* input_cpp_str
-        cdef total_replacements = 0
-        cdef int in_encoded = 0
-        cdef int repl_encoded = 0
+        cdef int total_replacements = 0
+        cdef object keeper
+        cdef int kind
+        cdef Template tmpl
 
         if callable(repl):
             # This is a callback, so let's use the custom function
             return self._subn_callback(repl, in_string, count)
-        if not is_bytes(repl):
-            raise TypeError("Expected callable or byte string")
-
-        repl_encoded = pystring_to_cstr(repl, &repl_c_str, &repl_size)
-        if repl_encoded == -1:
-            raise TypeError("expected string or buffer")
-
-
-        fixed_repl = NULL
-        cdef const char* s = repl_c_str
-        cdef const char* end = s + repl_size
-        cdef int c = 0
-        while s < end:
-            c = s[0]
-            if (c == '\\'):
-                s += 1
-                if s == end:
-                    raise RegexError("Invalid rewrite pattern")
-                c = s[0]
-                if c == '\\' or (c >= '0' and c <= '9'):
-                    if fixed_repl != NULL:
-                        fixed_repl.push_back('\\')
-                        fixed_repl.push_back(c)
-                else:
-                    if fixed_repl == NULL:
-                        fixed_repl = new cpp_string(repl_c_str, 
-                                                    s - repl_c_str - 1)
-                    if c == 'n':
-                        fixed_repl.push_back('\n')
-                    else:
-                        fixed_repl.push_back('\\')
-                        fixed_repl.push_back('\\')
-                        fixed_repl.push_back(c)
-            else:
-                if fixed_repl != NULL:
-                    fixed_repl.push_back(c)
+        if not (PyUnicode_Check(repl) or is_bytes(repl)):
+            raise TypeError("Expected callable or string")
 
-            s += 1
-        if fixed_repl != NULL:
-            sp = new StringPiece(fixed_repl.c_str())
-        else:
-            sp = new StringPiece(repl_c_str, repl_size)
-        try:
-            in_encoded = pystring_to_cstr(in_string, &input_c_str, &input_size)
-            if in_encoded == -1:
-                raise TypeError("expected string or buffer")
+        if count < 0:
+            count = 0
 
-            input_cpp_str = new cpp_string(input_c_str)
-            try:
-                if not count:
-                    total_replacements = pattern_GlobalReplace(input_cpp_str,
-                                                                self.re_pattern[0],
-                                                                sp[0])
-                elif count == 1:
-                    total_replacements = pattern_Replace(input_cpp_str,
-                                                            self.re_pattern[0],
-                                                            sp[0])
-                else:
-                    raise NotImplementedError("So far pyre2 does not support custom replacement counts")
-                result = cpp_to_pystring(input_cpp_str[0])
-            finally:
-                del input_cpp_str
+        keeper = input_to_cstr(in_string, &input_c_str, &input_size, &kind)
+        tmpl = self._template(repl, kind)
+        # Only ask RE2 for the groups the template refers to.
+        nvec = 1 + tmpl.max_group
+
+        text = StringPiece(input_c_str, input_size)
+        vec = new_StringPiece_array(nvec)
+        try:
+            re_pattern = self._enter()
+            with nogil:
+                out.reserve(input_size)
+                total_replacements = replace_matches(re_pattern, text,
+                                                     tmpl, vec, nvec,
+                                                     count, kind, &out)
+            self._leave()
         finally:
-            del fixed_repl
-            del sp
-        return (result, total_replacements)
+            delete_StringPiece_array(vec)
+
+        if total_replacements == 0 and (is_bytes(in_string) or
+                                        PyUnicode_Check(in_string)):
+            # Nothing was replaced, so there is no need to copy the output.
+            return (in_string, 0)
+        return (slice_result(out.data(), out.length(), kind), total_replacements)
     # end def
 
     def _subn_callback(self, callback, in_string, int count=0):
@@ -634,261 +1723,1562 @@ cdef class Pattern:
         This function is probably the hardest to implement correctly.
         This is my first attempt, but if anybody has a better solution, please help out.
         """
+        cdef RE2* re_pattern
         cdef Py_ssize_t size
         cdef int result
         cdef int endpos
         cdef int pos = 0
-        cdef int encoded = 0
+        cdef int next_pos
         cdef int num_repl = 0
         cdef char* input_c_str
         cdef StringPiece* sp
+        cdef int kind
         cdef Match m
         cdef list resultlist = []
+        cdef object keeper
+        cdef object empty
 
         if count < 0:
             count = 0
 
-        encoded = pystring_to_cstr(in_string, &input_c_str, &size)
-        if encoded == -1:
-            raise TypeError("expected string or buffer")
+        keeper = input_to_cstr(in_string, &input_c_str, &size, &kind)
+        empty = b'' if kind == BYTES_INPUT else u''
 
         sp = new StringPiece(input_c_str, size)
         try:
             while True:
-                m = Match(self, self.ngroups + 1)
+                m = self._new_match(in_string, keeper, input_c_str, kind)
+                re_pattern = self._enter()
                 with nogil:
-                    result = self.re_pattern.Match(sp[0], <int>pos, <int>size, 
+                    result = re_pattern.Match(sp[0], <int>pos, <int>size, 
                                     UNANCHORED, m.matches, self.ngroups + 1)
+                self._leave()
                 if result == 0:
                     break
 
                 endpos = m.matches[0].data() - input_c_str
-                resultlist.append(sp.data()[pos:endpos])
+                resultlist.append(slice_result(input_c_str + pos, endpos - pos, kind))
                 pos = endpos + m.matches[0].length()
 
-                m.named_groups = addressof(self.re_pattern.NamedCapturingGroups())
-                m.nmatches = self.ngroups + 1
-                m.match_string = in_string
-                resultlist.append(callback(m) or b'')
+                if kind == UNICODE_INPUT:
+                    m._endpos = len(in_string)
+                else:
+                    m._endpos = size
+                resultlist.append(callback(m) or empty)
 
                 num_repl += 1
                 if count and num_repl >= count:
                     break
+                if m.matches[0].length() == 0:
+                    # Search again one character on, the same way
+                    # replace_matches does.
+                    if pos >= size:
+                        break
+                    if kind == BYTES_INPUT:
+                        next_pos = pos + 1
+                    else:
+                        next_pos = utf8_skip(input_c_str, size, pos, 1)
+                    resultlist.append(slice_result(input_c_str + pos, next_pos - pos, kind))
+                    pos = next_pos
 
-            resultlist.append(sp.data()[pos:])
+            resultlist.append(slice_result(input_c_str + pos, size - pos, kind))
             #print("subn res", resultlist)
-            return (b''.join(resultlist), num_repl)
+            return (empty.join(resultlist), num_repl)
         finally:
             del sp
 
-_cache = {}
-_cache_repl = {}
+    def asearch(self, string, *args):
+        """
+        asearch(string[, pos[, endpos]]) --> coroutine
+        Coroutine version of search(). A string of at least the async
+        threshold is matched in the async executor, so that the event loop
+        keeps running; a shorter one is matched at once.
+        """
+        from re2 import _aio
+        return _aio._search(self, string, *args)
+
+    def afindall(self, string, *args):
+        """
+        afindall(string[, pos[, endpos]]) --> coroutine
+        Coroutine version of findall(), run as asearch() is.
+        """
+        from re2 import _aio
+        return _aio._findall(self, string, *args)
+
+    def asub(self, repl, string, int count=0):
+        """
+        asub(repl, string[, count = 0]) --> coroutine
+        Coroutine version of sub(), run as asearch() is.
+        """
+        from re2 import _aio
+        return _aio._sub(self, repl, string, count)
+
+    def afinditer_stream(self, reader, int chunk_size=1 << 16,
+                         int max_match_len=1 << 16):
+        """
+        afinditer_stream(reader[, chunk_size[, max_match_len]]) --> iterator
+        Asynchronous version of finditer_stream(), over the bytes read from
+        an asyncio.StreamReader, chunk_size bytes at a time.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be greater than 0")
+        if max_match_len < 0:
+            raise ValueError("max_match_len must not be negative")
+        from re2 import _aio
+        return _aio._finditer_stream(self, reader, chunk_size, max_match_len)
+
+cdef class MatchIterator:
+    """
+    Iterator returned by Pattern.finditer. It keeps the scan position
+    between steps and runs a single RE2 search for every match it yields,
+    so nothing past the current match is scanned until it is asked for.
+    """
+    cdef Pattern pattern
+    cdef object in_string
+    cdef object keeper
+    cdef char* in_c_str
+    cdef int kind
+    cdef Py_ssize_t total_size
+    cdef StringPiece sp
+    cdef int pos
+    cdef int size
+    cdef int start_pos
+    cdef int endpos
+    # Byte offset with its known character offset, moved up to the end of
+    # each match so translating unicode offsets stays linear overall.
+    cdef Py_ssize_t base_byte
+    cdef Py_ssize_t base_char
+    cdef bint done
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef RE2* re_pattern
+        cdef int result
+        cdef int match_end
+        cdef Pattern pattern = self.pattern
+        cdef Match m
+
+        if self.done:
+            raise StopIteration
 
-_MAXCACHE = 100
+        m = pattern._new_match(self.in_string, self.keeper, self.in_c_str,
+                               self.kind)
+        re_pattern = pattern._enter()
+        with nogil:
+            result = re_pattern.Match(self.sp, self.pos, self.size,
+                            UNANCHORED, m.matches, pattern.ngroups + 1)
+        pattern._leave()
+        if result == 0:
+            self.done = 1
+            # drop the references to the input as soon as we are exhausted
+            self.in_string = None
+            self.keeper = None
+            raise StopIteration
+
+        m._base_byte = self.base_byte
+        m._base_char = self.base_char
+        m._pos = self.start_pos
+        if self.endpos == -1:
+            m._endpos = self.total_size
+        else:
+            m._endpos = self.endpos
+
+        # offset the pos to move to the next point
+        match_end = m.matches[0].data() - self.in_c_str + m.matches[0].length()
+        if self.kind == UNICODE_INPUT:
+            self.base_char += utf8_char_count(self.in_c_str + self.base_byte,
+                                              match_end - self.base_byte)
+            self.base_byte = match_end
+        if m.matches[0].length() == 0:
+            if match_end >= self.size:
+                self.done = 1
+            if self.kind == BYTES_INPUT:
+                self.pos = match_end + 1
+            else:
+                self.pos = utf8_skip(self.in_c_str, self.size, match_end, 1)
+        else:
+            self.pos = match_end
+        return m
 
-def compile(pattern, int flags=0, int max_mem=8388608):
-    cachekey = (type(pattern),) + (pattern, flags)
-    p = _cache.get(cachekey)
-    if p is not None:
-        return p
-    p = _compile(pattern, flags, max_mem)
+cdef class StreamScanner:
+    """
+    StreamScanner(pattern[, max_match_len]) --> scanner
+    Find the matches of pattern in a stream given one chunk at a time with
+    feed(), as Pattern.finditer_stream() does. After each chunk, iterate
+    over the scanner for the matches that no more data can change, and
+    feed an empty chunk at the end of the stream for the rest.
+    """
+    cdef Pattern pattern
+    cdef int max_match_len
+    # The part of the stream still needed, with its stream offset, the
+    # search position in it, and whether the matches up to the last that
+    # more data may change have been taken.
+    cdef object window
+    cdef object keeper
+    cdef char* in_c_str
+    cdef Py_ssize_t size
+    cdef Py_ssize_t offset
+    cdef Py_ssize_t pos
+    cdef bint exhausted
+    cdef readonly bint eof
+
+    def __init__(self, Pattern pattern not None, int max_match_len=1 << 16):
+        if max_match_len < 0:
+            raise ValueError("max_match_len must not be negative")
+        self.pattern = pattern
+        self.max_match_len = max_match_len
+        self.window = b''
+        self.offset = 0
+        self.pos = 0
+
+    def feed(self, chunk):
+        """
+        feed(chunk)
+        Add the next chunk of bytes of the stream; an empty one ends it.
+        """
+        cdef Py_ssize_t keep
+        cdef int kind
+        if self.eof:
+            raise ValueError("the stream has ended")
+        if PyUnicode_Check(chunk):
+            raise TypeError("stream chunks must be bytes, not str")
+        if self.exhausted:
+            # No match starts before size - max_match_len.
+            self.pos = max(self.pos, self.size - self.max_match_len)
+        # Keep the text from the first position a match might still start
+        # at, and the byte before it, which \b and ^ look at.
+        keep = self.pos - 1
+        if keep > 0:
+            self.window = self.window[keep:]
+            self.offset += keep
+            self.pos -= keep
+        self.eof = not chunk
+        self.window = self.window + bytes(chunk)
+        self.keeper = input_to_cstr(self.window, &self.in_c_str, &self.size,
+                                    &kind)
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef RE2* re_pattern
+        cdef Pattern pattern = self.pattern
+        cdef StringPiece sp = StringPiece(self.in_c_str, self.size)
+        cdef Py_ssize_t start
+        cdef int result = 0
+        cdef Match m
 
-    if len(_cache) >= _MAXCACHE:
-        _cache.clear()
-    _cache[cachekey] = p
+        if not self.exhausted and self.pos <= self.size:
+            m = pattern._new_match(self.window, self.keeper, self.in_c_str,
+                                   BYTES_INPUT)
+            re_pattern = pattern._enter()
+            with nogil:
+                result = re_pattern.Match(sp, <int>self.pos, <int>self.size,
+                                UNANCHORED, m.matches, pattern.ngroups + 1)
+            pattern._leave()
+        if result:
+            start = m.matches[0].data() - self.in_c_str
+            # Which match starts here may change with more data.
+            result = self.eof or start + self.max_match_len < self.size
+        if not result:
+            self.exhausted = True
+            raise StopIteration
+
+        m._offset = self.offset
+        m._endpos = self.offset + self.size
+        self.pos = start + m.matches[0].length()
+        if m.matches[0].length() == 0:
+            self.pos += 1
+        return m
+
+cdef class SplitIterator:
+    """
+    Iterator returned by Pattern.isplit. It yields the same pieces as
+    Pattern.split, searching for the next match only once the pieces of
+    the previous one have been consumed.
+    """
+    cdef Pattern pattern
+    cdef object keeper
+    cdef char* in_c_str
+    cdef int kind
+    cdef StringPiece sp
+    cdef StringPiece* matches
+    cdef int pos
+    cdef int search_pos
+    cdef int maxsplit
+    cdef int num_split
+    # The next group of the last match to yield, or 0 for none.
+    cdef int group
+    cdef bint done
+
+    def __dealloc__(self):
+        delete_StringPiece_array(self.matches)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef RE2* re_pattern
+        cdef int found = 0
+        cdef int match_start
+        cdef StringPiece* piece
+        cdef Pattern pattern = self.pattern
+
+        if self.group:
+            piece = &self.matches[self.group]
+            self.group += 1
+            if self.group > pattern.ngroups:
+                self.group = 0
+            if piece.data() == NULL:
+                return None
+            return slice_result(piece.data(), piece.length(), self.kind)
+
+        if self.done:
+            raise StopIteration
+
+        if not self.maxsplit or self.num_split < self.maxsplit:
+            re_pattern = pattern._enter()
+            with nogil:
+                found = next_split(re_pattern, self.sp, &self.search_pos,
+                                   self.kind, self.matches,
+                                   pattern.ngroups + 1)
+            pattern._leave()
+        if not found:
+            self.done = 1
+            result = slice_result(self.in_c_str + self.pos,
+                                  self.sp.length() - self.pos, self.kind)
+            # drop the reference to the input as soon as we are exhausted
+            self.keeper = None
+            return result
+
+        match_start = self.matches[0].data() - self.in_c_str
+        result = slice_result(self.in_c_str + self.pos,
+                              match_start - self.pos, self.kind)
+        self.pos = match_start + self.matches[0].length()
+        self.num_split += 1
+        if pattern.ngroups > 0:
+            self.group = 1
+        return result
+
+cdef class PatternSet:
+    """
+    PatternSet(anchor=UNANCHORED, flags=0) --> pattern set
+    A collection of patterns matched together in a single pass over the
+    text. Add the patterns, compile the set once, and match() then returns
+    the indexes of all patterns that match.
+    """
+    cdef RE2_Set* re_set
+    cdef int _flags
+    cdef int _anchor
+    cdef int _size
+    cdef bint _compiled
+
+    def __cinit__(self, anchor=UNANCHORED, int flags=0,
+                  int max_mem=8388608):
+        cdef Options opts
+        if anchor not in (UNANCHORED, ANCHOR_START, ANCHOR_BOTH):
+            raise ValueError("anchor must be UNANCHORED, ANCHOR_START or "
+                             "ANCHOR_BOTH")
+        if flags & _I:
+            opts.set_case_sensitive(0)
+        opts.set_max_mem(max_mem)
+        opts.set_log_errors(0)
+        opts.set_encoding(EncodingUTF8)
+        self._flags = flags
+        self._anchor = anchor
+        self.re_set = new RE2_Set(opts, <re2_Anchor>self._anchor)
+
+    def __dealloc__(self):
+        del self.re_set
+
+    def __len__(self):
+        return self._size
+
+    property flags:
+        def __get__(self):
+            return self._flags
+
+    property anchor:
+        def __get__(self):
+            return self._anchor
+
+    def add(self, pattern):
+        """
+        add(pattern) --> int
+        Add a pattern to the set and return its index, which match()
+        reports it by. Patterns that only the re module supports are
+        rejected with RegexError.
+        """
+        cdef cpp_string error
+        cdef char* c_pattern
+        cdef Py_ssize_t length
+        cdef int index
+
+        if self._compiled:
+            raise RegexError("cannot add to a compiled PatternSet")
+        if PyUnicode_Check(pattern):
+            pattern = (<unicode>pattern).encode('utf8')
+        try:
+            pattern = prepare_pattern(pattern, self._flags)
+        except BackreferencesException:
+            raise RegexError("Backreferences not supported")
+        if pystring_to_cstr(pattern, &c_pattern, &length) == -1:
+            raise TypeError("pattern must be a string")
+
+        index = self.re_set.Add(StringPiece(c_pattern, length), &error)
+        if index < 0:
+            raise RegexError(cpp_to_pystring(error))
+        self._size += 1
+        return index
+
+    def compile(self):
+        """
+        compile()
+        Prepare the set for matching. No patterns can be added afterwards.
+        """
+        cdef bint compiled
+        if self._compiled:
+            return
+        with nogil:
+            compiled = self.re_set.Compile()
+        if not compiled:
+            raise RegexError("pattern set too large - compile failed")
+        self._compiled = True
+
+    def match(self, text):
+        """
+        match(text) --> list
+        Return the sorted indexes of the patterns that match text, in a
+        single pass with the GIL released.
+        """
+        cdef char* c_text
+        cdef Py_ssize_t size
+        cdef int kind
+        cdef object keeper
+        cdef StringPiece sp
+        cdef vector[int] ids
+
+        if not self._compiled:
+            raise RegexError("PatternSet must be compiled before matching")
+        keeper = input_to_cstr(text, &c_text, &size, &kind)
+        sp = StringPiece(c_text, size)
+        with nogil:
+            if self.re_set.Match(sp, &ids):
+                sort(ids.begin(), ids.end())
+        return ids
+
+cdef class FilteredPatterns:
+    """
+    FilteredPatterns(flags=0) --> filtered pattern collection
+    A large collection of patterns matched by first looking for the
+    literal strings ("atoms") each pattern requires. All atoms are found
+    in one Aho-Corasick pass over the text, and only the patterns whose
+    atoms are present are run.
+    """
+    cdef FilteredRE2* filtered
+    cdef AtomMatcher* matcher
+    cdef Options opts
+    cdef int _flags
+    cdef bint _compiled
+    cdef list _atoms
+
+    def __cinit__(self, int flags=0, int max_mem=8388608):
+        if flags & _I:
+            self.opts.set_case_sensitive(0)
+        self.opts.set_max_mem(max_mem)
+        self.opts.set_log_errors(0)
+        self.opts.set_encoding(EncodingUTF8)
+        self._flags = flags
+        self.filtered = new FilteredRE2()
+        self.matcher = new AtomMatcher()
+
+    def __dealloc__(self):
+        del self.filtered
+        del self.matcher
+
+    def __len__(self):
+        return self.filtered.NumRegexps()
+
+    property flags:
+        def __get__(self):
+            return self._flags
+
+    property atoms:
+        def __get__(self):
+            """The lower case atoms of the compiled patterns."""
+            return self._atoms
+
+    def add(self, pattern):
+        """
+        add(pattern) --> int
+        Add a pattern and return its index, which matches are reported by.
+        Patterns that only the re module supports are rejected with
+        RegexError.
+        """
+        cdef char* c_pattern
+        cdef Py_ssize_t length
+        cdef int index = -1
+        cdef RE2* re_pattern
+
+        if self._compiled:
+            raise RegexError("cannot add to compiled FilteredPatterns")
+        if PyUnicode_Check(pattern):
+            pattern = (<unicode>pattern).encode('utf8')
+        try:
+            pattern = prepare_pattern(pattern, self._flags)
+        except BackreferencesException:
+            raise RegexError("Backreferences not supported")
+        if pystring_to_cstr(pattern, &c_pattern, &length) == -1:
+            raise TypeError("pattern must be a string")
+
+        if self.filtered.Add(StringPiece(c_pattern, length), self.opts,
+                             &index) != NoError:
+            # FilteredRE2 only reports the error code.
+            re_pattern = new RE2(StringPiece(c_pattern, length), self.opts)
+            error_msg = cpp_to_pystring(re_pattern.error())
+            del re_pattern
+            raise RegexError(error_msg)
+        return index
+
+    def compile(self):
+        """
+        compile()
+        Extract the atoms of the patterns and prepare them for matching.
+        No patterns can be added afterwards.
+        """
+        cdef vector[cpp_string] atoms
+        cdef size_t i
+        if self._compiled:
+            return
+        if self.filtered.NumRegexps():
+            self.filtered.Compile(&atoms)
+        for i in range(atoms.size()):
+            self.matcher.Add(atoms[i], i)
+        self.matcher.Build()
+        self._atoms = [cpp_to_pystring(atoms[i]) for i in range(atoms.size())]
+        self._compiled = True
+
+    cdef _find_atoms(self, text, vector[int]* atoms, StringPiece* sp):
+        # Find the atoms in text, and point sp at its UTF-8 bytes. Returns
+        # the object keeping them alive.
+        cdef char* c_text
+        cdef Py_ssize_t size
+        cdef int kind
+        cdef bint non_ascii
+        cdef object keeper
+        cdef bytes lowered
+
+        if not self._compiled:
+            raise RegexError("FilteredPatterns must be compiled before matching")
+        keeper = input_to_cstr(text, &c_text, &size, &kind)
+        sp[0] = StringPiece(c_text, size)
+        with nogil:
+            non_ascii = self.matcher.Match(c_text, size, atoms)
+        if non_ascii:
+            # Atoms are lowered beyond ASCII too, so look again in a fully
+            # lowered copy of the text.
+            try:
+                lowered = slice_result(c_text, size, UNICODE_INPUT).lower().encode('utf8')
+            except UnicodeDecodeError:
+                return keeper
+            atoms.clear()
+            self.matcher.Match(lowered, len(lowered), atoms)
+        return keeper
+
+    def first_match(self, text):
+        """
+        first_match(text) --> int or None
+        Return the index of the first added pattern that matches text, or
+        None if none does.
+        """
+        cdef vector[int] atoms
+        cdef StringPiece sp
+        cdef int index = -1
+        keeper = self._find_atoms(text, &atoms, &sp)
+        if self.filtered.NumRegexps():
+            with nogil:
+                index = self.filtered.FirstMatch(sp, atoms)
+        if index < 0:
+            return None
+        return index
+
+    def all_matches(self, text):
+        """
+        all_matches(text) --> list
+        Return the sorted indexes of all patterns that match text.
+        """
+        cdef vector[int] atoms
+        cdef vector[int] matches
+        cdef StringPiece sp
+        keeper = self._find_atoms(text, &atoms, &sp)
+        if self.filtered.NumRegexps():
+            with nogil:
+                self.filtered.AllMatches(sp, atoms, &matches)
+                sort(matches.begin(), matches.end())
+        return matches
+
+cdef class Candidates:
+    """
+    The positions where a HybridPattern may match in one string, found
+    with its filter in increasing order. Like MatchIterator, it keeps the
+    byte offset of the last one with its character offset, so that
+    finding them all in a str stays linear overall.
+    """
+    cdef Pattern filter
+    cdef object keeper
+    cdef char* c_str
+    cdef int kind
+    # The byte size of the string up to endpos.
+    cdef Py_ssize_t size
+    cdef Py_ssize_t endpos
+    cdef Py_ssize_t base_byte
+    cdef Py_ssize_t base_char
+
+    cdef Py_ssize_t find(self, Py_ssize_t pos, re2_Anchor anchoring):
+        # Return where the first possible match starts at or after pos, -1
+        # if there is none, or -2 if pos is past endpos.
+        cdef RE2* re_pattern
+        cdef StringPiece sp = StringPiece(self.c_str, self.size)
+        cdef StringPiece match
+        cdef Py_ssize_t byte_pos, start
+        cdef int result
+        if pos < 0:
+            pos = 0
+        if self.endpos <= pos:
+            return -2
+        if self.kind != UNICODE_INPUT:
+            byte_pos = pos
+        else:
+            if pos < self.base_char:
+                self.base_byte = self.base_char = 0
+            byte_pos = utf8_skip(self.c_str, self.size, self.base_byte,
+                                 pos - self.base_char)
+        re_pattern = self.filter._enter()
+        with nogil:
+            result = re_pattern.Match(sp, <int>byte_pos, <int>self.size,
+                                      anchoring, &match, 1)
+        self.filter._leave()
+        if result == 0:
+            return -1
+        start = match.data() - self.c_str
+        if self.kind == UNICODE_INPUT:
+            self.base_byte = start
+            start = pos + utf8_char_count(self.c_str + byte_pos,
+                                          start - byte_pos)
+            self.base_char = start
+        return start
+
+cdef class HybridPattern:
+    """
+    A pattern that RE2 cannot run, such as one with backreferences or
+    lookarounds, matched by the re module only from where a relaxed RE2
+    pattern (see relax_pattern) finds a possible match. It behaves like
+    the compiled re pattern, available as the regex attribute, and gives
+    the same results, but skips the text that cannot match quickly.
+    """
+    cdef readonly object regex
+    cdef Pattern _filter
+    cdef bint _unicode
+
+    def __cinit__(self, regex, Pattern filter):
+        self.regex = regex
+        self._filter = filter
+        self._unicode = PyUnicode_Check(regex.pattern)
+
+    property pattern:
+        def __get__(self):
+            return self.regex.pattern
+
+    property flags:
+        def __get__(self):
+            return self.regex.flags
+
+    property groups:
+        def __get__(self):
+            return self.regex.groups
+
+    property groupindex:
+        def __get__(self):
+            return self.regex.groupindex
+
+    def __getattr__(self, name):
+        return getattr(self.regex, name)
+
+    def __repr__(self):
+        return 're2.HybridPattern(%r)' % (self.regex,)
+
+    cdef Candidates _candidates(self, string, Py_ssize_t endpos):
+        # The possible match starts in string, or None if the filter cannot
+        # tell them, in which case only re is asked.
+        cdef Candidates candidates
+        if self._unicode:
+            if not PyUnicode_Check(string):
+                return None
+        elif (PyUnicode_Check(string) or not PyObject_CheckBuffer(string)
+              or isinstance(string, memoryview) and string.itemsize != 1):
+            return None
+        candidates = Candidates.__new__(Candidates)
+        try:
+            candidates.keeper = input_to_cstr(string, &candidates.c_str,
+                                              &candidates.size,
+                                              &candidates.kind)
+        except UnicodeError:
+            # Lone surrogates have no UTF-8 form.
+            return None
+        candidates.filter = self._filter
+        candidates.endpos = min(endpos, len(string))
+        if candidates.endpos > 0:
+            candidates.size = char_to_byte_offset(
+                candidates.c_str, candidates.size, candidates.endpos,
+                candidates.kind)
+        return candidates
+
+    cdef Py_ssize_t _candidate(self, string, Py_ssize_t pos, Py_ssize_t endpos,
+                               re2_Anchor anchoring):
+        # Return where the first possible match starts at or after pos,
+        # -1 if there is none, or -2 if the filter cannot tell.
+        cdef Candidates candidates = self._candidates(string, endpos)
+        if candidates is None:
+            return -2
+        return candidates.find(pos, anchoring)
+
+    def search(self, string, pos=0, endpos=sys.maxsize):
+        start = self._candidate(string, pos, endpos, UNANCHORED)
+        if start == -1:
+            return None
+        elif start >= 0:
+            pos = start
+        return self.regex.search(string, pos, endpos)
+
+    def match(self, string, pos=0, endpos=sys.maxsize):
+        if self._candidate(string, pos, endpos, ANCHOR_START) == -1:
+            return None
+        return self.regex.match(string, pos, endpos)
+
+    def fullmatch(self, string, pos=0, endpos=sys.maxsize):
+        if self._candidate(string, pos, endpos, ANCHOR_BOTH) == -1:
+            return None
+        return self.regex.fullmatch(string, pos, endpos)
+
+    def test(self, string, pos=0, endpos=sys.maxsize):
+        return self.search(string, pos, endpos) is not None
+
+    def finditer(self, string, pos=0, endpos=sys.maxsize):
+        cdef Candidates candidates = self._candidates(string, endpos)
+        cdef Py_ssize_t start = -2
+        if candidates is not None:
+            start = candidates.find(pos, UNANCHORED)
+        if start == -2:
+            return self.regex.finditer(string, pos, endpos)
+        return self._finditer(string, candidates, start, endpos)
+
+    def _finditer(self, string, Candidates candidates, Py_ssize_t start,
+                  endpos):
+        # After a non-empty match re goes on searching from its end as a
+        # new search would, so skip ahead to the next possible match.
+        # After an empty one it must not match there again, which only
+        # the running iterator knows.
+        while start >= 0:
+            for m in self.regex.finditer(string, start, endpos):
+                yield m
+                if m.end() > m.start():
+                    start = candidates.find(m.end(), UNANCHORED)
+                    break
+            else:
+                return
+        if start == -2:
+            # Only an empty match is left, at endpos.
+            for m in self.regex.finditer(string, len(string)
+                                         if endpos > len(string) else endpos,
+                                         endpos):
+                yield m
+
+    def findall(self, string, pos=0, endpos=sys.maxsize):
+        cdef int ngroups = self.regex.groups
+        empty = string[:0] if self._unicode else b''
+        if ngroups == 0:
+            return [m.group() for m in self.finditer(string, pos, endpos)]
+        elif ngroups == 1:
+            return [m.group(1) if m.start(1) >= 0 else empty
+                    for m in self.finditer(string, pos, endpos)]
+        return [m.groups(empty) for m in self.finditer(string, pos, endpos)]
+
+    def count(self, string, pos=0, endpos=sys.maxsize):
+        cdef Py_ssize_t n = 0
+        for m in self.finditer(string, pos, endpos):
+            n += 1
+        return n
+
+    cdef bint _no_match(self, string):
+        # Whether re would return string as is from sub() or split().
+        return (type(string) is type(self.regex.pattern) and
+                self._candidate(string, 0, len(string), UNANCHORED) == -1)
+
+    def split(self, string, maxsplit=0):
+        if self._no_match(string):
+            return [string]
+        return self.regex.split(string, maxsplit)
+
+    def subn(self, repl, string, count=0):
+        # re checks the template even when nothing matches, so only a
+        # callable or a template without escapes can be skipped.
+        if ((callable(repl) or type(repl) is type(self.regex.pattern) and
+                repl.find(b'\\' if is_bytes(repl) else u'\\') < 0) and
+                self._no_match(string)):
+            return (string, 0)
+        return self.regex.subn(repl, string, count)
+
+    def sub(self, repl, string, count=0):
+        return self.subn(repl, string, count)[0]
+
+    def asearch(self, string, *args):
+        from re2 import _aio
+        return _aio._search(self, string, *args)
+
+    def afindall(self, string, *args):
+        from re2 import _aio
+        return _aio._findall(self, string, *args)
+
+    def asub(self, repl, string, count=0):
+        from re2 import _aio
+        return _aio._sub(self, repl, string, count)
+
+# Compiled patterns by (type, pattern, flags, max_mem), least recently used
+# first, each with its estimated footprint in bytes.
+_cache = collections.OrderedDict()
+
+_MAXCACHE = 512
+_CACHE_BUDGET = 256 << 20
+_MAXCACHE_TEMPLATES = 100
+# The smallest chunk of a subject scanned on a thread of its own.
+_MIN_PARALLEL_CHUNK = 1 << 16
+
+# A group name in a replacement template, as re accepts it.
+_GROUP_NAME = re.compile(r'(?!\d)\w+\Z', re.U)
+
+# What keeps a pattern searched with ^ and $ at every newline from finding
+# all the lines the pattern matches on its own.
+_UNFILTERED_LINES = re.compile(br'\\[Az]|\(\?[a-zA-Z]*-[a-zA-Z]*m')
+
+# Every compiled Pattern, for trim_idle().
+_patterns = weakref.WeakSet()
+_monotonic = getattr(time, 'monotonic', time.time)
+_get_ident = getattr(threading, 'get_ident', None) or threading._get_ident
+
+cdef Py_ssize_t _cache_hits = 0
+cdef Py_ssize_t _cache_misses = 0
+cdef Py_ssize_t _cache_evictions = 0
+cdef Py_ssize_t _cache_bytes = 0
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize',
+                  'budget', 'nbytes'])
+
+cdef Py_ssize_t _footprint(p, Py_ssize_t max_mem):
+    # A rough estimate of the memory a compiled pattern ends up using: its
+    # program at about 16 bytes an instruction, plus the DFA states built
+    # lazily while matching. RE2 does not report those, but searching a
+    # few hundred kilobytes grows a pattern by some 64 bytes an
+    # instruction at most (about 200KB for \w+ under UNICODE), so charge
+    # that, up to a share of max_mem.
+    cdef Py_ssize_t n
+    if not isinstance(p, Pattern):
+        return 1024 + 16 * len(p.pattern)
+    n = (<Pattern>p).re_pattern.ProgramSize()
+    return 1024 + len(p.pattern) + 16 * n + min(64 * n, max_mem // 32)
+
+def compile(pattern, int flags=0, int max_mem=8388608, bint per_thread=False):
+    global _cache_hits, _cache_misses, _cache_bytes
+    cachekey = (type(pattern), pattern, flags, max_mem, per_thread)
+    # Move a cached pattern to the most recently used end.
+    entry = _cache.pop(cachekey, None)
+    if entry is not None:
+        _cache_hits += 1
+        _cache[cachekey] = entry
+        return entry[0]
+    _cache_misses += 1
+    p = _compile(pattern, flags, max_mem, per_thread)
+    _cache_add(cachekey, pattern, p, max_mem)
     return p
 
+cdef _cache_add(cachekey, pattern, p, int max_mem):
+    global _cache_bytes
+    if _MAXCACHE > 0 and p is not pattern:
+        # Another thread may have compiled the same pattern meanwhile.
+        entry = _cache.pop(cachekey, None)
+        if entry is not None:
+            _cache_bytes -= entry[1]
+        size = _footprint(p, max_mem)
+        _cache[cachekey] = (p, size)
+        _cache_bytes += size
+        _evict()
+
+def compile_many(patterns, int flags=0, max_workers=None,
+                 int max_mem=8388608):
+    """
+    compile_many(patterns[, flags[, max_workers[, max_mem]]]) --> list
+    Compile each of an iterable of patterns as compile() does, and return
+    the list of pattern objects. RE2 builds the programs of the patterns
+    missing from the compile cache on up to max_workers native threads (one
+    per CPU by default), and they are added to the cache.
+    """
+    global _cache_hits, _cache_misses
+    cdef Options opts
+    cdef ParallelCompile work
+    cdef vector[CompileJob] jobs
+    cdef CompileJob job
+    cdef RE2* re_pattern
+    cdef char* pattern_cstr
+    cdef Py_ssize_t length
+    cdef int i
+    cdef size_t k
+    cdef list results = []
+    # The results still to be made: the index of the first one in
+    # results, its cache key, its pattern and its job, or -1 if there is
+    # nothing for RE2 to build.
+    cdef list pending = []
+    # The translated sources the jobs point into.
+    cdef list prepared = []
+    cdef list duplicates = []
+    cdef dict queued = {}
+
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    if max_workers < 1:
+        raise ValueError("max_workers must be greater than 0")
+
+    for pattern in patterns:
+        cachekey = (type(pattern), pattern, flags, max_mem, False)
+        entry = _cache.pop(cachekey, None)
+        if entry is not None:
+            _cache_hits += 1
+            _cache[cachekey] = entry
+            results.append(entry[0])
+            continue
+        if cachekey in queued:
+            _cache_hits += 1
+            duplicates.append((len(results), queued[cachekey]))
+            results.append(None)
+            continue
+        _cache_misses += 1
+        queued[cachekey] = len(pending)
+        source = None
+        if not isinstance(pattern, (Pattern, HybridPattern, SREPattern)):
+            source = _translate(pattern, flags)
+        if source is None:
+            pending.append((len(results), cachekey, pattern, -1))
+        else:
+            pending.append((len(results), cachekey, pattern, jobs.size()))
+            prepared.append(source)
+            pystring_to_cstr(source, &pattern_cstr, &length)
+            job.source = pattern_cstr
+            job.length = <int>length
+            job.re_pattern = NULL
+            jobs.push_back(job)
+        results.append(None)
+
+    _set_options(&opts, flags, max_mem)
+    work.opts = &opts
+    work.jobs = jobs.data()
+    work.njobs = jobs.size()
+    work.nthreads = max(1, min(max_workers, jobs.size()))
+    try:
+        if jobs.size():
+            with nogil:
+                run_parallel(work.nthreads, compile_jobs, &work)
+        for index, cachekey, pattern, i in pending:
+            if i < 0 and isinstance(pattern, (Pattern, HybridPattern,
+                                             SREPattern)):
+                p = _compile(pattern, flags, max_mem)
+            elif i < 0:
+                p = _fallback(pattern, flags, max_mem)
+            else:
+                re_pattern = jobs[i].re_pattern
+                jobs[i].re_pattern = NULL
+                p = _wrap(pattern, flags, max_mem, re_pattern)
+            _cache_add(cachekey, pattern, p, max_mem)
+            results[index] = p
+    finally:
+        # Free what an error left unclaimed.
+        for k in range(jobs.size()):
+            del jobs[k].re_pattern
+    for index, i in duplicates:
+        results[index] = results[pending[i][0]]
+    return results
+
+cdef _evict():
+    # Drop the least recently used patterns until the cache fits both its
+    # size and its memory budget.
+    global _cache_evictions, _cache_bytes
+    while len(_cache) > _MAXCACHE or (
+            _CACHE_BUDGET and _cache_bytes > _CACHE_BUDGET and _cache):
+        _cache_bytes -= _cache.popitem(last=False)[1][1]
+        _cache_evictions += 1
+
+def set_cache_size(int size):
+    """
+    Set the number of compiled patterns kept by compile(), evicting the
+    least recently used ones beyond it. A size of 0 disables the cache.
+    """
+    global _MAXCACHE
+    if size < 0:
+        raise ValueError("cache size must not be negative")
+    _MAXCACHE = size
+    _evict()
+
+def set_cache_budget(Py_ssize_t nbytes):
+    """
+    Set the approximate memory in bytes that the patterns kept by compile()
+    may use, counting their programs and DFA caches, and evict the least
+    recently used ones beyond it. A budget of 0 removes the limit.
+    """
+    global _CACHE_BUDGET
+    if nbytes < 0:
+        raise ValueError("cache budget must not be negative")
+    _CACHE_BUDGET = nbytes
+    _evict()
+
+def cache_info():
+    """
+    Return the statistics of the compile cache as a named tuple of hits,
+    misses, evictions, maxsize, currsize, budget and nbytes, the estimated
+    memory used by the cached patterns.
+    """
+    return CacheInfo(_cache_hits, _cache_misses, _cache_evictions,
+                     _MAXCACHE, len(_cache), _CACHE_BUDGET, _cache_bytes)
+
+def purge():
+    """
+    Clear the compile cache and its statistics.
+    """
+    global _cache_hits, _cache_misses, _cache_evictions, _cache_bytes
+    _cache.clear()
+    _cache_hits = _cache_misses = _cache_evictions = _cache_bytes = 0
+
+def trim_idle(double seconds):
+    """
+    Free the DFA state caches of the patterns not used for the last seconds,
+    as Pattern.trim() does, and return how many were trimmed.
+
+    Use is noticed when this function runs, so call it periodically, at
+    intervals shorter than seconds: a pattern counts as idle once it has
+    not been used between calls spanning that long.
+    """
+    cdef Pattern p
+    cdef int trimmed = 0
+    now = _monotonic()
+    for p in list(_patterns):
+        if p._uses != p._swept_uses:
+            p._swept_uses = p._uses
+            p._last_used = now
+        elif (now - p._last_used >= seconds and
+              p._uses != p._trimmed_uses and p.trim()):
+            trimmed += 1
+    return trimmed
+
 class BackreferencesException(Exception):
     pass
 
 class CharClassProblemException(Exception):
     pass
 
-WHITESPACE = set(b" \t\n\r\v\f")
-
-class Tokenizer:
-    def __init__(self, in_string):
-        self.string = in_string
-        self.index = 0
-        self.__next()
-
-    def __next(self):
-        if self.index >= len(self.string):
-            self.next = None
-            return
-        idx = self.index
-        ch = self.string[idx:idx+1]
-        if ch[0] == b"\\"[0]:
-            try:
-                c = self.string[idx + 1: idx+2]
-            except IndexError:
-                raise RegexError("bogus escape (end of line)")
-            ch = ch + c
-        self.index = self.index + len(ch)
-        self.next = ch
-    def get(self):
-        this = self.next
-        self.__next()
-        return this
-
-def prepare_pattern(pattern, int flags):
-    source = Tokenizer(pattern)
-    new_pattern = []
-
-    cdef bytes strflags = b''
-    if flags & _S:
-        strflags += b's'
-    if flags & _M:
-        strflags += b'm'
-
-    if strflags:
-        new_pattern.append(b'(?' + strflags + b')')
-
-    while 1:
-        this = source.get()
-        #print('this:', this)
-        if this is None:
+cdef inline bint is_pattern_space(char c) nogil:
+    return c == b' ' or c == b'\t' or c == b'\n' or c == b'\r' or \
+        c == b'\v' or c == b'\f'
+
+cdef inline bint is_ref_digit(char c) nogil:
+    return c >= b'1' and c <= b'7'
+
+cdef inline const char* unicode_class(char c, bint in_class) nogil:
+    # The RE2 form of \d, \w, \s and \D under UNICODE, written for use
+    # inside a character class or on its own. \W and \S follow in full.
+    if c == b'd':
+        return "\\p{Nd}"
+    elif c == b'w':
+        return "_\\p{L}\\p{Nd}" if in_class else "[_\\p{L}\\p{Nd}]"
+    elif c == b's':
+        return "\\s\\p{Z}" if in_class else "[\\s\\p{Z}]"
+    elif c == b'D':
+        return "\\P{Nd}" if in_class else "[^\\p{Nd}]"
+    elif c == b'W' and not in_class:
+        return "[^_\\p{L}\\p{Nd}]"
+    elif c == b'S' and not in_class:
+        return "[^\\s\\p{Z}]"
+    return NULL
+
+# Inside a character class under UNICODE, the complements of the parts
+# that \w and \s translate to, each as it can be written in a class.
+cdef const char** WORD_COMPLEMENTS = [
+    "\\x00-\\x5e\\x60-\\x{10ffff}", "\\P{L}", "\\P{Nd}"]
+cdef const char** SPACE_COMPLEMENTS = ["\\S", "\\P{Z}"]
+
+cdef Py_ssize_t translate_class(const char* s, Py_ssize_t n, Py_ssize_t i,
+                                int flags, cpp_string* out) except -1:
+    # Translate the character class starting after its [ at s[i], and
+    # return the index past its closing ]. \W and \S under UNICODE are the
+    # complements of unions of several categories, which an RE2 class
+    # cannot hold next to other members, so the class becomes an
+    # alternation: [X\W] is X or not \w, and [^X\W], \w minus X, is the
+    # union of every part of \w minus X.
+    cdef cpp_string rest
+    cdef bint negated = i < n and s[i] == b'^'
+    cdef bint word = False, space = False
+    cdef const char* translated
+    cdef int a, b
+    if negated:
+        i += 1
+    while True:
+        if i >= n:
+            raise RegexError("unexpected end of regular expression")
+        if s[i] == b']':
+            i += 1
             break
+        if s[i] == b'\\' and i + 1 < n:
+            translated = NULL
+            if flags & _U:
+                translated = unicode_class(s[i + 1], True)
+                word = word or s[i + 1] == b'W'
+                space = space or s[i + 1] == b'S'
+            if translated != NULL:
+                rest.append(translated)
+            elif not (flags & _U and (s[i + 1] == b'W' or s[i + 1] == b'S')):
+                rest.append(s + i, 2)
+            i += 2
+        else:
+            rest.push_back(s[i])
+            i += 1
+
+    if not word and not space:
+        out.append("[^" if negated else "[")
+        out.append(rest)
+        out.push_back(b']')
+        return i
+    out.append("(?:")
+    if not negated:
+        if rest.size():
+            out.push_back(b'[')
+            out.append(rest)
+            out.append("]|")
+        if word:
+            out.append("[^_\\p{L}\\p{Nd}]|")
+        if space:
+            out.append("[^\\s\\p{Z}]|")
+    elif rest.size() == 0 and not (word and space):
+        # [^\W] is \w itself.
+        out.append("[_\\p{L}\\p{Nd}]|" if word else "[\\s\\p{Z}]|")
+    else:
+        # A character in every one of the categories and not in X lies in
+        # some part of each of them, so take every combination of parts.
+        for a in range(3 if word else 1):
+            for b in range(2 if space else 1):
+                out.append("[^")
+                if word:
+                    out.append(WORD_COMPLEMENTS[a])
+                if space:
+                    out.append(SPACE_COMPLEMENTS[b])
+                out.append(rest)
+                out.append("]|")
+    # Drop the last |.
+    out.resize(out.size() - 1)
+    out.push_back(b')')
+    return i
+
+def prepare_pattern(bytes pattern, int flags):
+    """
+    Translate the syntax of the re module in a UTF-8 pattern into that of
+    RE2: apply the S, M, X and U flags, and raise BackreferencesException
+    for a backreference.
+    """
+    cdef const char* s = pattern
+    cdef Py_ssize_t n = len(pattern)
+    cdef Py_ssize_t i = 0
+    cdef const char* translated
+    cdef cpp_string out
+    cdef char c
+
+    out.reserve(n + 8)
+    if flags & (_S | _M):
+        out.append("(?")
+        if flags & _S:
+            out.push_back(b's')
+        if flags & _M:
+            out.push_back(b'm')
+        out.push_back(b')')
+
+    while i < n:
+        c = s[i]
         if flags & _X:
-            if this in WHITESPACE:
+            if is_pattern_space(c):
+                i += 1
                 continue
-            if this == b"#":
-                while 1:
-                    this = source.get()
-                    if this in (None, b"\n"):
-                        break
+            elif c == b'#':
+                while i < n and s[i] != b'\n':
+                    i += 1
+                i += 1
                 continue
 
-        if this[0] not in b'[\\':
-            new_pattern.append(this)
-            continue
-
-        elif this == b'[':
-            new_pattern.append(this)
-            while 1:
-                this = source.get()
-                if this is None:
-                    raise RegexError("unexpected end of regular expression")
-                elif this == b']':
-                    new_pattern.append(this)
-                    break
-                elif this[0] == b'\\'[0]:
-                    if flags & _U:
-                        if this[1] == b'd'[0]:
-                            new_pattern.append(b'\\p{Nd}')
-                        elif this[1] == b'w'[0]:
-                            new_pattern.append(b'_\\p{L}\\p{Nd}')
-                        elif this[1] == b's'[0]:
-                            new_pattern.append(b'\\s\\p{Z}')
-                        elif this[1] == b'D'[0]:
-                            new_pattern.append(b'\\P{Nd}')
-                        elif this[1] == b'W'[0]:
-                            # Since \w and \s are made out of several character groups,
-                            # I don't see a way to convert their complements into a group
-                            # without rewriting the whole expression, which seems too complicated.
-
-                            raise CharClassProblemException()
-                        elif this[1] == b'S'[0]:
-                            raise CharClassProblemException()
-                        else:
-                            new_pattern.append(this)
-                    else:
-                        new_pattern.append(this)
-                else:
-                    new_pattern.append(this)
-        elif this[0] == b'\\'[0]:
-            if this[1] in b'89':
+        if c == b'[':
+            i = translate_class(s, n, i + 1, flags, &out)
+        elif c != b'\\' or i + 1 == n:
+            # A trailing backslash is left for RE2 to report.
+            out.push_back(c)
+            i += 1
+        elif s[i + 1] == b'8' or s[i + 1] == b'9':
+            raise BackreferencesException()
+        elif is_ref_digit(s[i + 1]):
+            # Only three digits make an octal escape.
+            if not (i + 3 < n and is_ref_digit(s[i + 2]) and
+                    is_ref_digit(s[i + 3])):
                 raise BackreferencesException()
-            elif this[1] in b'1234567':
-                if source.next and source.next in b'1234567':
-                    this += source.get()
-                    if source.next and source.next in b'1234567':
-                        # all clear, this is an octal escape
-                        new_pattern.append(this)
-                    else:
-                        raise BackreferencesException()
-                else:
-                    raise BackreferencesException()
-            elif flags & _U:
-                if this[1] == b'd'[0]:
-                    new_pattern.append(b'\\p{Nd}')
-                elif this[1] == b'w'[0]:
-                    new_pattern.append(b'[_\\p{L}\\p{Nd}]')
-                elif this[1] == b's'[0]:
-                    new_pattern.append(b'[\\s\\p{Z}]')
-                elif this[1] == b'D'[0]:
-                    new_pattern.append(b'[^\\p{Nd}]')
-                elif this[1] == b'W'[0]:
-                    new_pattern.append(b'[^_\\p{L}\\p{Nd}]')
-                elif this[1] == b'S'[0]:
-                    new_pattern.append(b'[^\\s\\p{Z}]')
+            out.append(s + i, 4)
+            i += 4
+        else:
+            translated = NULL
+            if flags & _U:
+                translated = unicode_class(s[i + 1], False)
+            if translated != NULL:
+                out.append(translated)
+            else:
+                out.append(s + i, 2)
+            i += 2
+
+    return out.data()[:out.size()]
+
+
+# Code point ranges of the ASCII part of the character categories of re.
+_ASCII_DIGIT = [(0x30, 0x39)]
+_ASCII_WORD = [(0x30, 0x39), (0x41, 0x5a), (0x5f, 0x5f), (0x61, 0x7a)]
+_ASCII_SPACE = [(0x09, 0x0d), (0x20, 0x20)]
+# str.isspace() also holds for the separators \x1c to \x1f.
+_UNICODE_ASCII_SPACE = [(0x09, 0x0d), (0x1c, 0x20)]
+
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: (_ASCII_DIGIT, _ASCII_DIGIT, False),
+    sre_constants.CATEGORY_NOT_DIGIT: (_ASCII_DIGIT, _ASCII_DIGIT, True),
+    sre_constants.CATEGORY_WORD: (_ASCII_WORD, _ASCII_WORD, False),
+    sre_constants.CATEGORY_NOT_WORD: (_ASCII_WORD, _ASCII_WORD, True),
+    sre_constants.CATEGORY_SPACE: (_ASCII_SPACE, _UNICODE_ASCII_SPACE, False),
+    sre_constants.CATEGORY_NOT_SPACE: (_ASCII_SPACE, _UNICODE_ASCII_SPACE,
+                                       True),
+}
+
+cdef list merge_ranges(ranges):
+    cdef list result = []
+    for lo, hi in sorted(ranges):
+        if result and lo <= result[-1][1] + 1:
+            if hi > result[-1][1]:
+                result[-1] = (result[-1][0], hi)
+        else:
+            result.append((lo, hi))
+    return result
+
+cdef list complement_ranges(list ranges, int maxchar):
+    # ranges must be merged.
+    cdef list result = []
+    cdef int lo = 0
+    for a, b in ranges:
+        if a > lo:
+            result.append((lo, a - 1))
+        lo = b + 1
+    if lo <= maxchar:
+        result.append((lo, maxchar))
+    return result
+
+cdef class Relaxation:
+    # Translates a pattern parsed by sre_parse into an RE2 pattern that
+    # matches at least wherever the original matches. Backreferences
+    # become (?s:.*?), lookarounds are dropped, and where the tables of re
+    # and RE2 may disagree (Unicode categories, word boundaries and case
+    # folding) any non-ASCII character is let through.
+    cdef bint unicode
+    cdef int maxchar
+
+    cdef list category(self, category, bint superset):
+        # Ranges covering the category if superset, or covered by it.
+        ascii, wide, negated = _CATEGORIES[category]
+        if not self.unicode:
+            if negated:
+                return complement_ranges(ascii, self.maxchar)
+            return ascii
+        if superset:
+            if negated:
+                return complement_ranges(ascii, 0x7f) + [(0x80, self.maxchar)]
+            return wide + [(0x80, self.maxchar)]
+        if negated:
+            return complement_ranges(wide, 0x7f)
+        return ascii
+
+    cdef list fold(self, list ranges):
+        # Add the other case of the ASCII letters. With Unicode case folding
+        # some non-ASCII characters match ASCII letters and the other way
+        # round, so then take all of them.
+        cdef list result = list(ranges)
+        for lo, hi in ranges:
+            if lo <= 0x5a and hi >= 0x41:
+                result.append((max(lo, 0x41) + 0x20, min(hi, 0x5a) + 0x20))
+            if lo <= 0x7a and hi >= 0x61:
+                result.append((max(lo, 0x61) - 0x20, min(hi, 0x7a) - 0x20))
+            if self.unicode and hi >= 0x80:
+                result.extend([(0x41, 0x5a), (0x61, 0x7a)])
+        if self.unicode:
+            result.append((0x80, self.maxchar))
+        return merge_ranges(result)
+
+    cdef list members(self, items, int flags, bint superset):
+        cdef list ranges = []
+        for op, av in items:
+            if op is sre_constants.LITERAL:
+                ranges.append((av, av))
+            elif op is sre_constants.RANGE:
+                ranges.append(av)
+            elif op is sre_constants.CATEGORY:
+                ranges.extend(self.category(av, superset))
+            else:
+                raise ValueError(op)
+        ranges = merge_ranges(ranges)
+        if flags & _I:
+            ranges = self.fold(ranges)
+        return ranges
+
+    cdef str charclass(self, items, int flags):
+        cdef list ranges
+        if items and items[0][0] is sre_constants.NEGATE:
+            if flags & _I and self.unicode:
+                ranges = [(0, self.maxchar)]
+            else:
+                ranges = complement_ranges(
+                    self.members(items[1:], flags, False), self.maxchar)
+        else:
+            ranges = self.members(items, flags, True)
+        if not ranges:
+            return '[^\\x00-\\x{%x}]' % self.maxchar
+        return '[%s]' % ''.join([
+            '\\x{%x}' % lo if lo == hi else '\\x{%x}-\\x{%x}' % (lo, hi)
+            for lo, hi in ranges])
+
+    cdef str repeat(self, lo, hi, items, int flags):
+        # Only where a match starts matters, so repeats are lazy: RE2 then
+        # stops at the shortest match instead of scanning for the longest.
+        cdef str item = '(?:%s)' % self.sequence(items, flags)
+        # RE2 allows counts up to 1000, so larger ones are loosened.
+        if lo > 1000:
+            lo = 1000
+        if hi != sre_constants.MAXREPEAT and hi > 1000:
+            hi = sre_constants.MAXREPEAT
+        if hi == sre_constants.MAXREPEAT:
+            if lo == 0:
+                return item + '*?'
+            elif lo == 1:
+                return item + '+?'
+            return item + '{%d,}?' % lo
+        if lo == 0 and hi == 1:
+            return item + '??'
+        elif lo == hi:
+            return item + '{%d}' % lo
+        return item + '{%d,%d}?' % (lo, hi)
+
+    cdef str at(self, code, int flags):
+        if code is sre_constants.AT_BEGINNING:
+            return '(?m:^)' if flags & _M else '\\A'
+        elif code is sre_constants.AT_BEGINNING_STRING:
+            return '\\A'
+        elif code is sre_constants.AT_END:
+            # Without MULTILINE, $ also matches before a final newline.
+            return '(?m:$)'
+        elif code is sre_constants.AT_END_STRING:
+            return '\\z'
+        elif code is sre_constants.AT_BOUNDARY:
+            return '(?:)' if self.unicode else '\\b'
+        elif code is sre_constants.AT_NON_BOUNDARY:
+            return '(?:)' if self.unicode else '\\B'
+        raise ValueError(code)
+
+    cdef str sequence(self, items, int flags):
+        cdef list out = []
+        for op, av in items:
+            if op is sre_constants.LITERAL:
+                if flags & _I:
+                    out.append(self.charclass([(op, av)], flags))
                 else:
-                    new_pattern.append(this)
+                    out.append('\\x{%x}' % av)
+            elif op is sre_constants.NOT_LITERAL:
+                out.append(self.charclass(
+                    [(sre_constants.NEGATE, None),
+                     (sre_constants.LITERAL, av)], flags))
+            elif op is sre_constants.ANY:
+                out.append('(?s:.)' if flags & _S else '.')
+            elif op is sre_constants.IN:
+                out.append(self.charclass(av, flags))
+            elif op is sre_constants.BRANCH:
+                out.append('(?:%s)' % '|'.join([
+                    self.sequence(branch, flags) for branch in av[1]]))
+            elif op is sre_constants.SUBPATTERN:
+                inner = flags
+                if len(av) == 4:
+                    # Flags set or cleared for the group, as in (?i:...).
+                    inner = (flags | av[1]) & ~av[2]
+                    if inner & _L:
+                        raise ValueError('LOCALE')
+                out.append('(?:%s)' % self.sequence(av[-1], inner))
+            elif op in _REPEATS:
+                out.append(self.repeat(av[0], av[1], av[2], flags))
+            elif op is sre_constants.AT:
+                out.append(self.at(av, flags))
+            elif op is sre_constants.GROUPREF:
+                out.append('(?s:.*?)')
+            elif op is sre_constants.GROUPREF_EXISTS:
+                out.append('(?:%s|%s)' % (
+                    self.sequence(av[1], flags),
+                    self.sequence(av[2], flags) if av[2] else ''))
+            elif op in _ASSERTS:
+                out.append('(?:)')
+            elif op is _ATOMIC_GROUP:
+                out.append('(?:%s)' % self.sequence(av, flags))
             else:
-                new_pattern.append(this)
-
-    return b''.join(new_pattern)
+                raise ValueError(op)
+        return ''.join(out)
 
+_REPEATS = frozenset([sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+                      getattr(sre_constants, 'POSSESSIVE_REPEAT', None)])
+_ASSERTS = frozenset([sre_constants.ASSERT, sre_constants.ASSERT_NOT])
+_ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
 
-
-def _compile(pattern, int flags=0, int max_mem=8388608):
+def relax_pattern(pattern, int flags=0):
     """
-    Compile a regular expression pattern, returning a pattern object.
+    Translate a pattern that RE2 cannot run as is, such as one with
+    backreferences or lookarounds, into an RE2 pattern that matches at
+    every position where the original may match. Return None if the
+    pattern cannot be translated.
     """
-    cdef char* pattern_cstr
-    cdef Py_ssize_t length
-    cdef StringPiece* s
-    cdef Options opts
-    cdef int error_code
-    cdef int encoded = 0
+    cdef Relaxation relaxation = Relaxation()
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (re.error, ValueError):
+        return None
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    flags = state.flags
+    if flags & _L:
+        return None
+    relaxation.unicode = flags & _U and not flags & _A
+    relaxation.maxchar = 0x10ffff if PyUnicode_Check(pattern) else 0xff
+    try:
+        return relaxation.sequence(parsed, flags).encode('ascii')
+    except ValueError:
+        return None
 
-    if isinstance(pattern, (Pattern, SREPattern)):
-        if flags:
-            raise ValueError('Cannot process flags argument with a compiled pattern')
-        return pattern
 
-    cdef bytes original_pattern = pattern
+cdef object _fallback(original_pattern, int flags, int max_mem):
+    # Match with the re module, past a relaxed RE2 pattern when there is a
+    # useful one: one that cannot match the empty string, and so does not
+    # match everywhere.
+    cdef Options opts
+    cdef RE2* re_pattern
+    cdef Pattern filter
+    regex = re.compile(original_pattern, flags)
+    relaxed = relax_pattern(original_pattern, flags)
+    if relaxed is None:
+        return regex
+    opts.set_max_mem(max_mem)
+    opts.set_log_errors(0)
+    if PyUnicode_Check(original_pattern):
+        opts.set_encoding(EncodingUTF8)
+    else:
+        opts.set_encoding(EncodingLatin1)
+    re_pattern = new RE2(StringPiece(<bytes>relaxed, len(relaxed)), opts)
+    if not re_pattern.ok():
+        del re_pattern
+        return regex
+    filter = Pattern()
+    filter.pattern = relaxed
+    filter.re_pattern = re_pattern
+    filter.ngroups = re_pattern.NumberOfCapturingGroups()
+    filter._unicode = PyUnicode_Check(original_pattern)
+    filter._last_used = _monotonic()
+    _patterns.add(filter)
+    if filter.test(original_pattern[:0]):
+        return regex
+    return HybridPattern(regex, filter)
+
+# A group followed by a quantifier, without which a pattern need not be
+# parsed for _empty_repeat().
+_REPEATED_GROUP = re.compile(br'\)[*+{]')
+
+cdef list _subpatterns(op, av):
+    # The parsed subpatterns directly under an sre_parse item.
+    if op is sre_constants.SUBPATTERN:
+        return [av[-1]]
+    if op in _REPEATS:
+        return [av[2]]
+    if op is sre_constants.BRANCH:
+        return av[1]
+    if op is sre_constants.GROUPREF_EXISTS:
+        return [av[1], av[2]] if av[2] else [av[1]]
+    if op in _ASSERTS:
+        return [av[1]]
+    if op is _ATOMIC_GROUP:
+        return [av]
+    return []
+
+cdef bint _empty_repeat(items):
+    # Whether items repeat a group that can match the empty string, as in
+    # (a*)*. re tries an empty iteration of it where RE2 stops, which can
+    # change what the groups capture and even which match is found.
+    for op, av in items:
+        if op in _REPEATS and av[1] > 1 and av[2].getwidth()[0] == 0:
+            return True
+        for sub in _subpatterns(op, av):
+            if _empty_repeat(sub):
+                return True
+    return False
+
+cdef object _translate(pattern, int flags):
+    # Return the RE2 syntax of a str or bytes pattern, encoded in UTF-8, or
+    # None once the fallback to the re module has been notified.
+    original = pattern
+    if PyUnicode_Check(pattern):
+        # RE2 works on UTF-8, so a str pattern is encoded once here
+        pattern = (<unicode>pattern).encode('utf8')
+    elif not is_bytes(pattern):
+        raise TypeError("first argument must be a string or compiled pattern")
     try:
-        pattern = prepare_pattern(original_pattern, flags)
-        #print("prepared", pattern)
+        prepared = prepare_pattern(pattern, flags)
     except BackreferencesException:
         error_msg = "Backreferences not supported"
-        if current_notification == <int>FALLBACK_EXCEPTION:
-            # Raise an exception regardless of the type of error.
-            raise RegexError(error_msg)
-        elif current_notification == <int>FALLBACK_WARNING:
-            warnings.warn("WARNING: Using re module. Reason: %s" % error_msg)
-        return re.compile(original_pattern, flags)
-    except CharClassProblemException:
-        error_msg = "\W and \S not supported inside character classes"
-        if current_notification == <int>FALLBACK_EXCEPTION:
-            # Raise an exception regardless of the type of error.
-            raise RegexError(error_msg)
-        elif current_notification == <int>FALLBACK_WARNING:
-            warnings.warn("WARNING: Using re module. Reason: %s" % error_msg)
-        return re.compile(original_pattern, flags)
-
+    else:
+        if not _REPEATED_GROUP.search(pattern):
+            return prepared
+        try:
+            parsed = sre_parse.parse(original, flags)
+        except (re.error, ValueError, OverflowError):
+            # Leave the error to RE2.
+            return prepared
+        if not _empty_repeat(parsed):
+            return prepared
+        error_msg = "Repeated empty groups not supported"
+    if current_notification == <int>FALLBACK_EXCEPTION:
+        # Raise an exception regardless of the type of error.
+        raise RegexError(error_msg)
+    elif current_notification == <int>FALLBACK_WARNING:
+        warnings.warn("WARNING: Using re module. Reason: %s" % error_msg)
+    return None
+
+cdef void _set_options(Options* opts, int flags, int max_mem):
     # Set the options given the flags above.
     if flags & _I:
-        opts.set_case_sensitive(0);
-
+        opts.set_case_sensitive(0)
     opts.set_max_mem(max_mem)
     opts.set_log_errors(0)
     opts.set_encoding(EncodingUTF8)
 
-    # We use this function to get the proper length of the string.
-    encoded = pystring_to_cstr(pattern, &pattern_cstr, &length)
-    if encoded == -1:
-        raise TypeError("first argument must be a string or compiled pattern")
-
-    #print("trying pattern", pattern)
-    s = new StringPiece(pattern_cstr, length)
-
-    cdef RE2* re_pattern = new RE2(s[0], opts)
-
+cdef object _wrap(original_pattern, int flags, int max_mem, RE2* re_pattern):
+    # Return the pattern object for a newly built RE2, which it takes over,
+    # or when RE2 rejected the pattern, raise or fall back to the re module.
+    cdef int error_code
     if not re_pattern.ok():
         # Something went wrong with the compilation.
-        del s
         error_msg = cpp_to_pystring(re_pattern.error())
         error_code = re_pattern.error_code()
         del re_pattern
@@ -902,16 +3292,53 @@ def _compile(pattern, int flags=0, int max_mem=8388608):
             raise RegexError(error_msg)
         elif current_notification == <int>FALLBACK_WARNING:
             warnings.warn("WARNING: Using re module. Reason: %s" % error_msg)
-        return re.compile(original_pattern, flags)
+        return _fallback(original_pattern, flags, max_mem)
 
     cdef Pattern pypattern = Pattern()
     pypattern.pattern = original_pattern
     pypattern.re_pattern = re_pattern
     pypattern.ngroups = re_pattern.NumberOfCapturingGroups()
     pypattern._flags = flags
-    del s
+    pypattern._unicode = PyUnicode_Check(original_pattern)
+    pypattern._last_used = _monotonic()
+    _patterns.add(pypattern)
     return pypattern
 
+def _compile(pattern, int flags=0, int max_mem=8388608, bint per_thread=False):
+    """
+    Compile a regular expression pattern, returning a pattern object.
+
+    With per_thread, every thread matching with the pattern besides the
+    one compiling it gets a replica of the program on its first match, so
+    that threads do not contend for one DFA cache. This multiplies the
+    memory the pattern uses by the number of threads.
+    """
+    cdef char* pattern_cstr
+    cdef Py_ssize_t length
+    cdef Options opts
+    cdef RE2* re_pattern
+
+    if isinstance(pattern, (Pattern, HybridPattern, SREPattern)):
+        if flags:
+            raise ValueError('Cannot process flags argument with a compiled pattern')
+        if per_thread:
+            raise ValueError('Cannot process per_thread argument with a compiled pattern')
+        return pattern
+
+    prepared = _translate(pattern, flags)
+    if prepared is None:
+        return _fallback(pattern, flags, max_mem)
+    _set_options(&opts, flags, max_mem)
+    pystring_to_cstr(prepared, &pattern_cstr, &length)
+    # Building the program is the slow part, so other threads may run.
+    with nogil:
+        re_pattern = new RE2(StringPiece(pattern_cstr, length), opts)
+    p = _wrap(pattern, flags, max_mem, re_pattern)
+    if per_thread and isinstance(p, Pattern):
+        (<Pattern>p)._replicas = threading.local()
+        (<Pattern>p)._owner = _get_ident()
+    return p
+
 def search(pattern, in_string, int flags=0):
     """
     Scan through string looking for a match to the pattern, returning
@@ -926,6 +3353,89 @@ def match(pattern, in_string, int flags=0):
     """
     return compile(pattern, flags).match(in_string)
 
+def fullmatch(pattern, in_string, int flags=0):
+    """
+    Try to apply the pattern to all of the string, returning
+    a match object, or None if no match was found.
+    """
+    return compile(pattern, flags).fullmatch(in_string)
+
+def test(pattern, in_string, int flags=0):
+    """
+    Return True if the pattern matches anywhere in the string, without
+    building a match object.
+    """
+    return compile(pattern, flags).test(in_string)
+
+def count(pattern, in_string, int flags=0):
+    """
+    Return the number of non-overlapping matches of the pattern in the
+    string.
+    """
+    return compile(pattern, flags).count(in_string)
+
+def findall_parallel(pattern, in_string, int flags=0, max_workers=None,
+                     max_match_len=None):
+    """
+    Return the same list as findall(), scanning chunks of the string on
+    several native threads.
+    """
+    return compile(pattern, flags).findall_parallel(in_string, max_workers,
+                                                    max_match_len)
+
+def count_parallel(pattern, in_string, int flags=0, max_workers=None,
+                   max_match_len=None):
+    """
+    Return the same number as count(), scanning chunks of the string on
+    several native threads.
+    """
+    return compile(pattern, flags).count_parallel(in_string, max_workers,
+                                                  max_match_len)
+
+cdef object _map_file(path):
+    # Map a file read-only, telling the kernel it will be read through
+    # once, front to back.
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # An empty file cannot be mapped.
+            return b''
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return mapping
+
+def search_file(pattern, path, int flags=0):
+    """
+    Scan through the file at path looking for a match to the pattern, as
+    search() does, over a read-only memory map of the file instead of a
+    copy of its content. The match object holds on to the mapping.
+    """
+    return search(pattern, _map_file(path), flags)
+
+def findall_file(pattern, path, int flags=0):
+    """
+    Return the same list as findall() on the content of the file at path,
+    scanning a read-only memory map of the file.
+    """
+    mapping = _map_file(path)
+    try:
+        return findall(pattern, mapping, flags)
+    finally:
+        if isinstance(mapping, mmap.mmap):
+            mapping.close()
+
+def count_file(pattern, path, int flags=0):
+    """
+    Return the number of non-overlapping matches of the pattern in the file
+    at path, scanning a read-only memory map of the file without the GIL.
+    """
+    mapping = _map_file(path)
+    try:
+        return count(pattern, mapping, flags)
+    finally:
+        if isinstance(mapping, mmap.mmap):
+            mapping.close()
+
 def finditer(pattern, in_string, int flags=0):
     """
     Return an list of all non-overlapping matches in the
@@ -951,6 +3461,13 @@ def split(pattern, in_string, int maxsplit=0):
     """
     return compile(pattern).split(in_string, maxsplit)
 
+def isplit(pattern, in_string, int maxsplit=0):
+    """
+    Return an iterator over the substrings of the source string split by
+    the occurrences of the pattern.
+    """
+    return compile(pattern).isplit(in_string, maxsplit)
+
 def sub(pattern, repl, in_string, int count=0):
     """
     Return the string obtained by replacing the leftmost
@@ -982,6 +3499,8 @@ del c
 
 def escape(pattern):
     "Escape all non-alphanumeric characters in pattern."
+    if PyUnicode_Check(pattern):
+        return escape((<unicode>pattern).encode('utf8')).decode('utf8')
     s = list(pattern)
     alphanum = _alphanum
     for i in range(len(pattern)):
@@ -0,0 +1,136 @@
+#ifndef __ATOM_MATCHER_H
+#define __ATOM_MATCHER_H
+
+#include <string>
+#include <utility>
+#include <vector>
+
+/* An Aho-Corasick automaton over the atoms returned by FilteredRE2::Compile.
+   Match() reports every atom found in a text in a single pass, folding
+   ASCII letters to lower case on the fly since the atoms are lower case. */
+class AtomMatcher {
+ public:
+  AtomMatcher() : nterminals_(0), built_(false), non_ascii_atoms_(false) {
+    nodes_.push_back(Node());
+  }
+
+  /* Add the atom with the given index. Must be called before Build(). */
+  void Add(const std::string& atom, int index) {
+    int state = 0;
+    for (size_t i = 0; i < atom.size(); i++) {
+      unsigned char c = atom[i];
+      if (c >= 0x80)
+        non_ascii_atoms_ = true;
+      int next = Child(state, c);
+      if (next < 0) {
+        next = nodes_.size();
+        nodes_.push_back(Node());
+        nodes_[state].next.push_back(std::make_pair(c, next));
+      }
+      state = next;
+    }
+    if (nodes_[state].atom < 0) {
+      nodes_[state].atom = index;
+      nodes_[state].terminal = nterminals_++;
+    }
+  }
+
+  /* Compute the failure links. */
+  void Build() {
+    std::vector<int> queue;
+    for (int c = 0; c < 256; c++)
+      root_[c] = 0;
+    for (size_t i = 0; i < nodes_[0].next.size(); i++) {
+      int child = nodes_[0].next[i].second;
+      root_[nodes_[0].next[i].first] = child;
+      nodes_[child].fail = 0;
+      nodes_[child].output = nodes_[0].atom >= 0 ? 0 : -1;
+      queue.push_back(child);
+    }
+    for (size_t head = 0; head < queue.size(); head++) {
+      int state = queue[head];
+      for (size_t i = 0; i < nodes_[state].next.size(); i++) {
+        unsigned char c = nodes_[state].next[i].first;
+        int child = nodes_[state].next[i].second;
+        int fail = Step(nodes_[state].fail, c);
+        nodes_[child].fail = fail;
+        nodes_[child].output = nodes_[fail].atom >= 0 ? fail
+                                                      : nodes_[fail].output;
+        queue.push_back(child);
+      }
+    }
+    built_ = true;
+  }
+
+  /* Append the indexes of the atoms found in text to atoms, each once.
+     Return whether the text contains non-ASCII bytes while some atom does
+     too, in which case the caller should also try a text whose non-ASCII
+     letters are lowered. */
+  bool Match(const char* text, size_t n, std::vector<int>* atoms) const {
+    std::vector<char> seen(nterminals_, 0);
+    bool non_ascii = false;
+    int state = 0;
+    Report(0, &seen, atoms);
+    for (size_t i = 0; i < n; i++) {
+      unsigned char c = text[i];
+      if (c >= 'A' && c <= 'Z')
+        c += 'a' - 'A';
+      else if (c >= 0x80)
+        non_ascii = true;
+      state = Step(state, c);
+      Report(state, &seen, atoms);
+    }
+    return non_ascii && non_ascii_atoms_;
+  }
+
+  bool built() const { return built_; }
+
+ private:
+  struct Node {
+    Node() : fail(0), output(-1), atom(-1), terminal(-1) {}
+    std::vector<std::pair<unsigned char, int> > next;
+    int fail;      /* longest proper suffix that is also a prefix */
+    int output;    /* nearest state on the fail chain ending an atom */
+    int atom;      /* atom ending here, or -1 */
+    int terminal;  /* index into the seen flags, or -1 */
+  };
+
+  int Child(int state, unsigned char c) const {
+    const std::vector<std::pair<unsigned char, int> >& next =
+        nodes_[state].next;
+    for (size_t i = 0; i < next.size(); i++)
+      if (next[i].first == c)
+        return next[i].second;
+    return -1;
+  }
+
+  int Step(int state, unsigned char c) const {
+    while (state != 0) {
+      int next = Child(state, c);
+      if (next >= 0)
+        return next;
+      state = nodes_[state].fail;
+    }
+    return root_[c];
+  }
+
+  void Report(int state, std::vector<char>* seen,
+              std::vector<int>* atoms) const {
+    if (nodes_[state].atom < 0)
+      state = nodes_[state].output;
+    /* Once a state has been reported, so has the rest of its chain. */
+    while (state >= 0 && !(*seen)[nodes_[state].terminal]) {
+      (*seen)[nodes_[state].terminal] = 1;
+      atoms->push_back(nodes_[state].atom);
+      state = state == 0 ? -1 : nodes_[state].output;
+    }
+  }
+
+  std::vector<Node> nodes_;
+  int root_[256];
+  int nterminals_;
+  bool built_;
+  bool non_ascii_atoms_;
+};
+
+#endif
@@ -2,6 +2,9 @@
 #define __RE2MACROS_H
 
 #include <stdio.h>
+#include <system_error>
+#include <thread>
+#include <vector>
 #include "re2/stringpiece.h"
 
 static inline re2::StringPiece * new_StringPiece_array(int n)
@@ -21,4 +24,28 @@ static inline void delete_StringPiece_array(re2::StringPiece* ptr)
 #define pattern_Replace(A, B, C) re2::RE2::Replace((A), (B), (C))
 #define pattern_GlobalReplace(A, B, C) re2::RE2::GlobalReplace((A), (B), (C))
 
+typedef void (*parallel_fn)(void*, int);
+
+/* Call fn(arg, 0) .. fn(arg, n - 1), each on its own native thread, and
+   wait for all of them. Calls whose thread cannot be started are made on
+   the calling thread instead. */
+static inline void run_parallel(int n, parallel_fn fn, void* arg)
+{
+    std::vector<std::thread> threads;
+    std::vector<int> pending;
+    threads.reserve(n);
+    for (int i = 1; i < n; i++) {
+        try {
+            threads.push_back(std::thread(fn, arg, i));
+        } catch (const std::system_error&) {
+            pending.push_back(i);
+        }
+    }
+    fn(arg, 0);
+    for (size_t i = 0; i < pending.size(); i++)
+        fn(arg, pending[i]);
+    for (size_t i = 0; i < threads.size(); i++)
+        threads[i].join();
+}
+
 #endif
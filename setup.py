@@ -62,7 +62,8 @@ re2_ext = Extension( "re2._re2",
         libraries=["re2"],
         library_dirs=[RE2_LIB_PATH],
         runtime_library_dirs=[RE2_LIB_PATH],
-        extra_compile_args=['-Wno-unused-function'],
+        extra_compile_args=['-Wno-unused-function', '-pthread'],
+        extra_link_args=['-pthread'],
     )
 
 # re2_ext = Extension( "re2.tester",
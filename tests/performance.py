@@ -58,7 +58,11 @@ def main(tests):
         for i, module in enumerate(modules):
             # We pre-compile the pattern, because that's
             # what people do.
+            if method.fallback:
+                # Part of the work needs the re module.
+                re2.set_fallback_notification(re2.FALLBACK_QUIETLY)
             current_re[0] = module.compile(method.pattern)
+            re2.set_fallback_notification(re2.FALLBACK_EXCEPTION)
 
             results[i] = method(current_re[0], **method.data)
 
@@ -121,12 +125,13 @@ def benchmarks_to_ReST(benchmarks):
 
 
 # # Convenient decorator for registering a new test.
-def register_test(name, pattern, num_runs = 100, **data):
+def register_test(name, pattern, num_runs = 100, fallback = False, **data):
     def decorator(method):
         global tests
         tests[name] = method
         method.pattern = pattern
         method.num_runs = num_runs
+        method.fallback = fallback
         method.data = data
         def wrapped_f(*args):
             method(*args)
@@ -182,6 +187,426 @@ def findall_uriemail(pattern, data):
 
 
 
+_wikilines = None
+def getwikilines():
+    global _wikilines
+    if _wikilines is None:
+        _wikilines = getwikidata().splitlines()
+    return _wikilines
+
+
+@register_test("Filter lines (search)",
+             r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]'.encode('utf-8'),
+             10,
+             data=getwikilines())
+def filter_lines_search(pattern, data):
+    """
+    Count the lines containing a wiki link with bool(search()).
+    """
+    search = pattern.search
+    return sum(1 for line in data if search(line))
+
+
+@register_test("Filter lines (test)",
+             r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]'.encode('utf-8'),
+             10,
+             data=getwikilines())
+def filter_lines_test(pattern, data):
+    """
+    Count the lines containing a wiki link with test(), where available.
+    """
+    test = getattr(pattern, 'test', pattern.search)
+    return sum(1 for line in data if test(line))
+
+
+
+@register_test("Filter lines (search loop)",
+             r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]'.encode('utf-8'),
+             10,
+             data=getwikilines())
+def filter_lines_search_loop(pattern, data):
+    """
+    Collect search() results for every line with a Python loop.
+    """
+    return sum(1 for m in [pattern.search(line) for line in data] if m)
+
+
+@register_test("Filter lines (search_many)",
+             r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]'.encode('utf-8'),
+             10,
+             data=getwikilines())
+def filter_lines_search_many(pattern, data):
+    """
+    Collect search() results for every line with search_many(), where available.
+    """
+    if hasattr(pattern, 'search_many'):
+        results = pattern.search_many(data)
+    else:
+        results = [pattern.search(line) for line in data]
+    return sum(1 for m in results if m)
+
+
+@register_test("Filter lines (grep_lines)",
+             r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]'.encode('utf-8'),
+             10,
+             data=getwikidata())
+def filter_lines_grep(pattern, data):
+    """
+    Count the lines with a wiki link with grep_lines(), where available.
+    """
+    if hasattr(pattern, 'grep_lines'):
+        return len(pattern.grep_lines(data))
+    search = pattern.search
+    return sum(1 for line in data.split(b'\n') if search(line))
+
+
+@register_test("Split pages",
+             r'</page>\s*'.encode('utf-8'),
+             10,
+             data=getwikidata())
+def split_pages(pattern, data):
+    """
+    Split the dump into pages with split().
+    """
+    return len(pattern.split(data))
+
+
+@register_test("Split pages (lazy)",
+             r'</page>\s*'.encode('utf-8'),
+             10,
+             data=getwikidata())
+def split_pages_lazy(pattern, data):
+    """
+    Walk the pages of the dump with isplit(), where available.
+    """
+    isplit = getattr(pattern, 'isplit', pattern.split)
+    return sum(1 for page in isplit(data))
+
+
+_genomedata = None
+def getgenomedata():
+    global _genomedata
+    if _genomedata is None:
+        with open('genome.dat', 'rb') as f:
+            _genomedata = f.read()
+    return _genomedata
+
+
+@register_test("Findall genome motif",
+             r'c[cg]g[at]{2,}g'.encode('utf-8'),
+             10,
+             data=getgenomedata())
+def findall_genome(pattern, data):
+    """
+    Find all motifs in the genome with findall().
+    """
+    return len(pattern.findall(data))
+
+
+@register_test("Findall genome motif (parallel)",
+             r'c[cg]g[at]{2,}g'.encode('utf-8'),
+             10,
+             data=getgenomedata())
+def findall_genome_parallel(pattern, data):
+    """
+    Find all motifs in the genome with findall_parallel(), where available.
+    """
+    if hasattr(pattern, 'findall_parallel'):
+        return len(pattern.findall_parallel(data))
+    return len(pattern.findall(data))
+
+
+_rules = None
+def getrules():
+    """
+    A few hundred word rules, as a rule engine would check on every line.
+    """
+    global _rules
+    if _rules is None:
+        words = sorted(set(re.findall(br'\b[a-z]{8,}\b', getwikidata())))
+        _rules = [br'\b' + word + br'\b' for word in words[::50][:300]]
+    return _rules
+
+
+_compiled_rules = {}
+def compiled_rules(pattern):
+    """
+    The rules compiled with the module that compiled pattern.
+    """
+    module = re2 if isinstance(pattern, re2.Pattern) else re
+    if module not in _compiled_rules:
+        _compiled_rules[module] = [module.compile(rule) for rule in getrules()]
+    return _compiled_rules[module]
+
+
+_filtered_rules = []
+def filtered_rules():
+    if not _filtered_rules:
+        patterns = re2.FilteredPatterns()
+        for rule in getrules():
+            patterns.add(rule)
+        patterns.compile()
+        _filtered_rules.append(patterns)
+    return _filtered_rules[0]
+
+
+_rule_set = []
+def rule_set():
+    if not _rule_set:
+        patterns = re2.PatternSet()
+        for rule in getrules():
+            patterns.add(rule)
+        patterns.compile()
+        _rule_set.append(patterns)
+    return _rule_set[0]
+
+
+def search_rules(pattern, data):
+    rules = compiled_rules(pattern)
+    return sum(1 for line in data for rule in rules if rule.search(line))
+
+
+@register_test("Match rules (search loop)",
+             br'\b[a-z]{8,}\b',
+             1,
+             data=getwikilines()[:2000])
+def match_rules_loop(pattern, data):
+    """
+    Find the rules matching each line by searching with every rule.
+    """
+    return search_rules(pattern, data)
+
+
+@register_test("Match rules (PatternSet)",
+             br'\b[a-z]{8,}\b',
+             1,
+             data=getwikilines()[:2000])
+def match_rules_set(pattern, data):
+    """
+    Find the rules matching each line with a PatternSet, for re2.
+    """
+    if not isinstance(pattern, re2.Pattern):
+        return search_rules(pattern, data)
+    patterns = rule_set()
+    return sum(len(patterns.match(line)) for line in data)
+
+
+@register_test("Match rules (FilteredPatterns)",
+             br'\b[a-z]{8,}\b',
+             1,
+             data=getwikilines()[:2000])
+def match_rules_filtered(pattern, data):
+    """
+    Find the rules matching each line with FilteredPatterns, for re2.
+    """
+    if not isinstance(pattern, re2.Pattern):
+        return search_rules(pattern, data)
+    patterns = filtered_rules()
+    return sum(len(patterns.all_matches(line)) for line in data)
+
+
+_wikiwords = None
+def getwikiwords():
+    global _wikiwords
+    if _wikiwords is None:
+        _wikiwords = sorted(set(re.findall(br'\w+', getwikidata())))
+    return _wikiwords
+
+
+@register_test("Filter sorted keys (scan)",
+             br'inter[a-z]+',
+             10,
+             data=getwikiwords())
+def filter_sorted_scan(pattern, data):
+    """
+    Find the sorted words the pattern matches with fullmatch() on each.
+    """
+    return len([word for word in data if pattern.fullmatch(word)])
+
+
+@register_test("Filter sorted keys (range)",
+             br'inter[a-z]+',
+             10,
+             data=getwikiwords())
+def filter_sorted_range(pattern, data):
+    """
+    Find the sorted words matched with filter_sorted(), where available.
+    """
+    if hasattr(pattern, 'filter_sorted'):
+        return len(pattern.filter_sorted(data))
+    return len([word for word in data if pattern.fullmatch(word)])
+
+
+@register_test("Compile patterns in rotation",
+             br'\b[a-z]{8,}\b',
+             10,
+             data=getrules()[:150])
+def compile_rotation(pattern, data):
+    """
+    Compile 150 patterns in turn, as code calling module functions does.
+    """
+    module = re2 if isinstance(pattern, re2.Pattern) else re
+    for i in range(10):
+        for rule in data:
+            module.compile(rule)
+    return len(data)
+
+
+@register_test("Findall category links (lookarounds)",
+             br'(?<=\[\[)Category:[^\]|]+(?=\]\])',
+             10,
+             fallback=True,
+             data=getwikidata())
+def findall_lookarounds(pattern, data):
+    """
+    Find category links with lookarounds, which RE2 cannot run by itself.
+    """
+    return len(pattern.findall(data))
+
+
+@register_test("Compile keyword alternation",
+             br'\b[a-z]{8,}\b',
+             10,
+             data=b'|'.join(word for word in getwikiwords()
+                            if word.isalpha())[:100000])
+def compile_alternation(pattern, data):
+    """
+    Compile a 100KB alternation of words, skipping the compile cache.
+    """
+    module = re2 if isinstance(pattern, re2.Pattern) else re
+    module.purge()
+    return module.compile(data).groups
+
+
+@register_test("Compile rules (compile_many)",
+             br'\b[a-z]{8,}\b',
+             10,
+             data=getrules())
+def compile_rules_many(pattern, data):
+    """
+    Compile 300 rules from an empty cache, with compile_many() where available.
+    """
+    module = re2 if isinstance(pattern, re2.Pattern) else re
+    module.purge()
+    if hasattr(module, 'compile_many'):
+        return len(module.compile_many(data))
+    return len([module.compile(rule) for rule in data])
+
+
+_pool = None
+def count_on_threads(pattern, chunks):
+    """
+    Count the matches in each chunk on a thread of its own, the threads
+    kept from one run to the next.
+    """
+    global _pool
+    if _pool is None:
+        from multiprocessing.pool import ThreadPool
+        _pool = ThreadPool(4)
+    if hasattr(pattern, 'count'):
+        count = pattern.count
+    else:
+        count = lambda chunk: len(pattern.findall(chunk))
+    return sum(_pool.map(count, chunks))
+
+
+def getwikichunks():
+    data = getwikidata()
+    size = len(data) // 4
+    return [data[i * size:(i + 1) * size] for i in range(4)]
+
+
+@register_test("Count words on 4 threads (shared)",
+             br'\b\w+(?:tion|ment|ness|ing)s?\b',
+             10,
+             chunks=getwikichunks())
+def count_threads_shared(pattern, chunks):
+    """
+    Count matches in four chunks on four threads sharing one pattern.
+    """
+    return count_on_threads(pattern, chunks)
+
+
+@register_test("Count words on 4 threads (per_thread)",
+             br'\b\w+(?:tion|ment|ness|ing)s?\b',
+             10,
+             chunks=getwikichunks())
+def count_threads_per_thread(pattern, chunks):
+    """
+    Count matches in four chunks on four threads with per-thread replicas.
+    """
+    if isinstance(pattern, re2.Pattern):
+        pattern = re2.compile(pattern.pattern, per_thread=True)
+    return count_on_threads(pattern, chunks)
+
+
+_logfile = None
+def getlogfile():
+    """
+    The path of a synthetic access log of about 32 MB, written to a
+    temporary file the first time a benchmark needs it and removed at exit.
+    """
+    global _logfile
+    if _logfile is None:
+        import atexit
+        import tempfile
+        lines = []
+        for i in range(1000):
+            lines.append(('10.0.%d.%d - - [12/Mar/2024:10:%02d:%02d] '
+                          '"GET /page/%d HTTP/1.1" %d %d\n' % (
+                              i % 7, i % 251, i % 60, i * 7 % 60, i,
+                              500 + i % 4 if i % 20 == 0 else 200,
+                              i * 37 % 9000)).encode('ascii'))
+        block = b''.join(lines)
+        fd, _logfile = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(fd, 'wb') as f:
+            for i in range((32 << 20) // len(block)):
+                f.write(block)
+        atexit.register(os.remove, _logfile)
+    return _logfile
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@register_test("Findall in a file (read)",
+             br'" 5\d\d (\d+)',
+             3)
+def findall_file_read(pattern):
+    """
+    Read a 32 MB log into memory and find the sizes of its server errors.
+    """
+    return len(pattern.findall(read_file(getlogfile())))
+
+
+@register_test("Findall in a file (mmap)",
+             br'" 5\d\d (\d+)',
+             3)
+def findall_file_mmap(pattern):
+    """
+    Find the sizes of the server errors in a 32 MB log with findall_file().
+    """
+    path = getlogfile()
+    if isinstance(pattern, re2.Pattern):
+        return len(re2.findall_file(pattern, path))
+    return len(pattern.findall(read_file(path)))
+
+
+@register_test("Count in a file (mmap)",
+             br'" 5\d\d (\d+)',
+             3)
+def count_file_mmap(pattern):
+    """
+    Count the server errors in a 32 MB log with count_file(), where available.
+    """
+    path = getlogfile()
+    if isinstance(pattern, re2.Pattern):
+        return re2.count_file(pattern, path)
+    return len(pattern.findall(read_file(path)))
+
+
 # @register_test("Replace WikiLinks",
 #              r'(\[\[(^\|)+.*?\]\])'.encode('utf-8'),
 #              data=getwikidata())
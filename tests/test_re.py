@@ -60,8 +60,10 @@ class ReTests(unittest.TestCase):
         self.assertEqual(re.sub(b'(?P<unk>x)', b'\g<unk>\g<unk>', b'xx'), b'xxxx')
         self.assertEqual(re.sub(b'(?P<unk>x)', b'\g<1>\g<1>', b'xx'), b'xxxx')
 
-        self.assertEqual(re.sub(b'a',b'\\t\\n\\v\\r\\f\\a\\b\\B\\Z\\a\\A\\w\\W\\s\\S\\d\\D',b'a'),
-                         b'\t\n\v\r\f\a\b\\B\\Z\a\\A\\w\\W\\s\\S\\d\\D')
+        self.assertEqual(re.sub(b'a',b'\\t\\n\\v\\r\\f\\a\\b\\a',b'a'),
+                         b'\t\n\v\r\f\a\b\a')
+        for c in b'BZAwWsSdD':
+            self.assertRaises(re.error, re.sub, b'a', b'\\' + bytes([c]), b'a')
         self.assertEqual(re.sub(b'a', b'\t\n\v\r\f\a', b'a'), b'\t\n\v\r\f\a')
         self.assertEqual(re.sub(b'a', b'\t\n\v\r\f\a', b'a'),
                          (chr(9)+chr(10)+chr(11)+chr(13)+chr(12)+chr(7)).encode('utf-8'))